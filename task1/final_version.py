@@ -4,32 +4,323 @@
 Execute test task.
 
 Tested on Ubuntu 14.04
-Python version 2.7.6 and 2.7.11
+Python version 2.7.6 and 2.7.11, Python 3 is needed for blake2b checksums
 """
 
 import sys
 import os
+import io
+import json
+import math
+import time
+import random
+import errno
+import fcntl
+import hashlib
+import collections
+import glob
+import threading
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 
 LOG = 'process.log'
+KILO = 1024
+BLOCK_SIZE = 1024 * KILO
+QUEUE_DEPTH = 8
+FICLONE = 0x40049409
+COPY_MODES = ('copy', 'hardlink', 'reflink')
+VERIFY_MODES = ('full', 'fast')
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EPERM,
+                      errno.EMLINK, getattr(errno, 'EOPNOTSUPP', 95),
+                      errno.ENOTTY)
+BATCH_FILES = 64 * KILO
+DELETE_BATCH = 256
+DEFAULT_WORKLOAD = {
+    'dirs': 5,
+    'fanout': 0,
+    'depth': 0,
+    'files': 1000,
+    'size': 'dir',
+    'seed': 0,
+}
+SIZE_UNITS = {'': 1, 'K': KILO, 'M': KILO ** 2, 'G': KILO ** 3,
+              'T': KILO ** 4}
+SUB_BUCKETS = 64
+STRING_TYPES = (str, type(u''))
+clock = getattr(time, 'perf_counter', time.time)
+worker_local = threading.local()
+progress = {'percent': None}
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with HDR-like log-linear buckets.
+
+    Latencies are kept in nanoseconds, every power of two range is
+    split into 64 buckets, so values are kept with precision better
+    than 1.6% at any scale.
+    """
+
+    def __init__(self):
+        """Initialize empty histogram."""
+        self.counts = collections.defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def bucket(self, value):
+        """Return bucket index for value in nanoseconds."""
+        if value < 2 * SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - 7
+        return shift * SUB_BUCKETS + (value >> shift)
+
+    def bucket_value(self, index):
+        """Return the highest value in bucket."""
+        if index < 2 * SUB_BUCKETS:
+            return index
+        shift = index // SUB_BUCKETS - 1
+        return ((index - shift * SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Add latency in seconds."""
+        value = max(0, int(seconds * 1e9))
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Return latency in seconds for percentile in [0, 100]."""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.bucket_value(index), self.max) / 1e9
+        return self.max / 1e9
+
+
+class Metrics:
+    """Collect operations latencies, amounts and bytes by stages."""
+
+    def __init__(self):
+        """Initialize empty metrics."""
+        self.stages = collections.OrderedDict()
+        self.stage = None
+
+    def start_stage(self, name):
+        """Start stage, next operations are recorded in it."""
+        self.stage = {'started': clock(), 'wall': None,
+                      'ops': collections.OrderedDict()}
+        self.stages[name] = self.stage
+
+    def stop_stage(self):
+        """Finish current stage."""
+        self.stage['wall'] = clock() - self.stage['started']
+
+    def record(self, op, seconds, size=0, error=False):
+        """Record operation latency and amount of bytes."""
+        ops = self.stage['ops']
+        if op not in ops:
+            ops[op] = {'histogram': LatencyHistogram(), 'bytes': 0,
+                       'errors': 0}
+        ops[op]['histogram'].record(seconds)
+        ops[op]['bytes'] += size
+        ops[op]['errors'] += int(bool(error))
+
+    def report(self):
+        """
+        Return report with latency percentiles, ops/s and MB/s.
+
+        Rates are calculated by stage wall time, latencies are in
+        seconds.
+        """
+        report = collections.OrderedDict()
+        for name, stage in self.stages.items():
+            wall = stage['wall'] or clock() - stage['started']
+            ops = collections.OrderedDict()
+            for op, data in stage['ops'].items():
+                histogram = data['histogram']
+                ops[op] = {
+                    'count': histogram.count,
+                    'errors': data['errors'],
+                    'bytes': data['bytes'],
+                    'mean': histogram.total / 1e9 / histogram.count,
+                    'p50': histogram.percentile(50),
+                    'p99': histogram.percentile(99),
+                    'p999': histogram.percentile(99.9),
+                    'max': histogram.max / 1e9,
+                    'ops_per_s': histogram.count / wall if wall else None,
+                    'mb_per_s': data['bytes'] / 1e6 / wall if wall else None,
+                }
+            report[name] = {'wall': wall, 'ops': ops}
+        return report
+
+
+metrics = Metrics()
 
 
 def print_progress(cur_step, max_step):
-    """Show process progress."""
+    """Show process progress, bar is redrawn only when it changes."""
+    percent = 100 * (cur_step + 1) // max_step
+    if percent == progress['percent'] and cur_step + 1 < max_step:
+        return
+    progress['percent'] = percent
     sys.stdout.write('\r')
-    sys.stdout.write("[%-100s] %d%%" %
-                     ('=' * (100 * (cur_step + 1) / max_step),
-                      100 * (cur_step + 1) / max_step))
+    sys.stdout.write("[%-100s] %d%%" % ('=' * percent, percent))
     sys.stdout.flush()
 
 
-def make_dirs(dir_num):
-    """Create directories."""
+def parse_size(text):
+    """Return amount of bytes for size like '512', '4K', '1.5M' or '2G'."""
+    text = str(text).strip().upper()
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    size = float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit]
+    if size < 0:
+        raise ValueError("negative size '%s'" % text)
+    return int(size)
+
+
+def parse_size_spec(spec):
+    """
+    Parse files size distribution.
+
+    'dir' gives N kilobytes files in dir_N, 'fixed:SIZE', 'uniform:MIN:MAX'
+    and 'lognormal:MEDIAN:SIGMA[:MAX]' give random sizes.
+    Return (distribution name, parameters) pair.
+    """
+    parts = spec.split(':')
+    name, params = parts[0], parts[1:]
+    try:
+        if name == 'dir' and not params:
+            return name, ()
+        if name == 'fixed' and len(params) == 1:
+            return name, (parse_size(params[0]),)
+        if name == 'uniform' and len(params) == 2:
+            low, high = parse_size(params[0]), parse_size(params[1])
+            if low <= high:
+                return name, (low, high)
+        if name == 'lognormal' and len(params) in (2, 3):
+            sizes = (parse_size(params[0]), float(params[1]))
+            if len(params) == 3:
+                sizes += (parse_size(params[2]),)
+            if sizes[0] > 0 and sizes[1] >= 0:
+                return name, sizes
+    except ValueError:
+        pass
+    raise ValueError("wrong files size distribution '%s'" % spec)
+
+
+def load_workload(filename=None, **overrides):
+    """
+    Return workload spec from JSON file and overrides.
+
+    Spec keys: 'dirs' top directories, 'fanout' subdirectories in every
+    directory, 'depth' nesting levels of subdirectories, 'files' files in
+    every deepest directory, 'size' files size distribution and 'seed'
+    for random sizes. Missed keys are taken from default workload.
+    """
+    spec = dict(DEFAULT_WORKLOAD)
+    if filename:
+        with open(filename) as f:
+            spec.update(json.load(f))
+    spec.update((k, v) for k, v in overrides.items() if v is not None)
+    unknown = set(spec) - set(DEFAULT_WORKLOAD)
+    if unknown:
+        raise ValueError("unknown workload keys: %s" %
+                         ', '.join(sorted(unknown)))
+    for key in ('dirs', 'fanout', 'depth', 'files', 'seed'):
+        value = spec[key]
+        if (not isinstance(value, int) or isinstance(value, bool) or
+                value < 0):
+            raise ValueError("workload '%s' must be non-negative integer"
+                             % key)
+    if spec['dirs'] < 1:
+        raise ValueError("workload needs at least one directory")
+    if not isinstance(spec['size'], STRING_TYPES):
+        raise ValueError("workload 'size' must be string like 'fixed:4K'")
+    parse_size_spec(spec['size'])
+    return spec
+
+
+def leaf_dirs(spec, path):
+    """Return directories with files in tree under path."""
+    if not spec['fanout'] or not spec['depth']:
+        return [path]
+    dirs = [path]
+    for _ in range(spec['depth']):
+        dirs = ["%s/sub_%s" % (d, n) for d in dirs
+                for n in range(1, spec['fanout'] + 1)]
+    return dirs
+
+
+def tree_dirs(spec, path):
+    """Yield all directories of tree under path from top to bottom."""
+    yield path
+    if spec['fanout'] and spec['depth']:
+        sub_spec = dict(spec, depth=spec['depth'] - 1)
+        for n in range(1, spec['fanout'] + 1):
+            for d in tree_dirs(sub_spec, "%s/sub_%s" % (path, n)):
+                yield d
+
+
+def files_amount(spec):
+    """Return amount of files in one top directory."""
+    leaves = spec['fanout'] ** spec['depth'] if spec['fanout'] else 1
+    return spec['files'] * leaves
+
+
+def file_sizes(spec, x):
+    """Yield sizes of files in dir_x by workload distribution."""
+    name, params = parse_size_spec(spec['size'])
+    rnd = random.Random(spec['seed'] * 1000003 + x)
+    while True:
+        if name == 'dir':
+            yield KILO * x
+        elif name == 'fixed':
+            yield params[0]
+        elif name == 'uniform':
+            yield rnd.randint(params[0], params[1])
+        else:
+            size = int(rnd.lognormvariate(math.log(params[0]), params[1]))
+            yield min(size, params[2]) if len(params) == 3 else size
+
+
+def file_tasks(spec, x):
+    """Yield (path, size) pairs for new files in dir_x."""
+    sizes = file_sizes(spec, x)
+    for path in leaf_dirs(spec, "./dir_%s" % x):
+        for n in range(1, spec['files'] + 1):
+            size = next(sizes)
+            f_name = "%s_%s_%s" % (
+                size, datetime.now().strftime("%Y-%m-%d_%H:%M:%S"), n)
+            yield "%s/%s" % (path, f_name), size
+
+
+def make_dirs(spec):
+    """Create top directories with their subdirectories."""
     has_fails = False
-    for x in xrange(1, dir_num + 1):
-        if os.system("mkdir dir_%s 2>>%s" % (x, LOG)):
-            has_fails = True
-        print_progress(x, dir_num + 1)
+    dirs = [d for x in range(1, spec['dirs'] + 1)
+            for d in tree_dirs(spec, "dir_%s" % x)]
+    with open(LOG, 'a') as log:
+        for x, d in enumerate(dirs, 1):
+            started = clock()
+            try:
+                os.mkdir(d)
+                metrics.record('mkdir', clock() - started)
+            except OSError as e:
+                metrics.record('mkdir', clock() - started, error=True)
+                has_fails = True
+                log.write("%s: %s\n" % (d, e))
+            print_progress(x, len(dirs) + 1)
     if has_fails:
         print("\tFAILED")
         os.system("cat %s" % LOG)
@@ -38,48 +329,960 @@ def make_dirs(dir_num):
         print("\tOK")
 
 
-def make_files(path, k_size):
-    """Create 1000 files with specified size in Kilobytes."""
-    amount = 1001
-    KILO = 1024
+def worker_buffer():
+    """Return preallocated buffer of current worker thread or process."""
+    if not hasattr(worker_local, 'buffer'):
+        worker_local.buffer = bytearray(BLOCK_SIZE)
+    return worker_local.buffer
+
+
+def random_block(size):
+    """
+    Return view of worker buffer filled with random data.
+
+    Every worker thread or process keeps its own preallocated buffer
+    and opened /dev/urandom, so no memory is allocated per file.
+    """
+    return fill_random(worker_buffer(), size)
+
+
+def fill_random(buf, size):
+    """Fill beginning of buffer with random data, return its view."""
+    if not hasattr(worker_local, 'urandom'):
+        worker_local.urandom = io.open('/dev/urandom', 'rb', buffering=0)
+    view = memoryview(buf)[:size]
+    filled = 0
+    while filled < size:
+        filled += worker_local.urandom.readinto(view[filled:])
+    return view
+
+
+def write_random_file(task):
+    """
+    Create file with random data.
+
+    Return (error message or None, latency in seconds) pair.
+    """
+    f_path, size = task
+    started = clock()
+    try:
+        with io.open(f_path, 'wb') as f:
+            left = size
+            while left > 0:
+                block = random_block(min(left, BLOCK_SIZE))
+                f.write(block)
+                left -= len(block)
+    except (IOError, OSError) as e:
+        return "%s: %s" % (f_path, e), clock() - started
+    return None, clock() - started
+
+
+def make_pool(workers, processes=False):
+    """Create pool of threads or processes."""
+    if processes:
+        return multiprocessing.Pool(workers)
+    return ThreadPool(workers)
+
+
+def batches(iterable, size):
+    """Yield lists of up to 'size' items from iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def make_files(tasks, amount, workers=1, processes=False):
+    """
+    Create files with random data by (path, size) tasks.
+
+    Files are written by pool of 'workers' threads or processes, tasks
+    are taken by batches, so amount of files isn't limited by memory.
+    """
+    has_fails = False
+    pool = make_pool(workers, processes)
+    try:
+        with open(LOG, 'a') as log:
+            x = 0
+            for batch in batches(tasks, BATCH_FILES):
+                results = pool.imap(write_random_file, batch, chunksize=16)
+                for (_, size), (error, latency) in zip(batch, results):
+                    x += 1
+                    metrics.record('create', latency, size, error)
+                    if error:
+                        has_fails = True
+                        log.write(error + '\n')
+                    print_progress(x, amount + 1)
+    finally:
+        pool.close()
+        pool.join()
+    if has_fails:
+        print("\tFAILED")
+        os.system("cat %s" % LOG)
+    else:
+        print("\tOK")
+
+
+def generate_blocks(next_task, free, to_hash):
+    """
+    Pipeline stage: fill free buffers with random data for files.
+
+    Error stops the stage, it is passed on as block without buffer with
+    error message instead of flag. End of stage is always passed on.
+    """
+    f_path = None
+    try:
+        while True:
+            f_path = None
+            task = next_task()
+            if task is None:
+                break
+            f_path, size = task
+            left = size
+            while True:
+                buf = free.get()
+                length = min(left, BLOCK_SIZE)
+                try:
+                    fill_random(buf, length)
+                except BaseException:
+                    free.put(buf)
+                    raise
+                left -= length
+                to_hash.put((f_path, buf, length, left == 0))
+                if left == 0:
+                    break
+    except Exception as e:
+        to_hash.put((f_path, None, 0, "%s: %s" % (
+            f_path or "files generation", e)))
+    finally:
+        to_hash.put(None)
+
+
+def hash_blocks(algorithm, to_hash, to_write):
+    """
+    Pipeline stage: hash blocks in files order and pass them on.
+
+    The last block of file is passed with (file digest, hashing time)
+    pair instead of flag, error blocks are passed on as they are.
+    End of stage is always passed on.
+    """
+    digest = hashlib.new(algorithm)
+    hashing = 0
+    f_path = None
+    try:
+        while True:
+            item = to_hash.get()
+            if item is None:
+                return
+            f_path, buf, length, last = item
+            if buf is None:
+                digest = hashlib.new(algorithm)
+                hashing = 0
+                to_write.put(item)
+                continue
+            started = clock()
+            digest.update(memoryview(buf)[:length])
+            hashing += clock() - started
+            if last:
+                item = (f_path, buf, length, (digest.hexdigest(), hashing))
+                digest = hashlib.new(algorithm)
+                hashing = 0
+            to_write.put(item)
+    except Exception as e:
+        to_write.put((f_path, None, 0, "%s: %s" % (f_path, e)))
+    finally:
+        to_write.put(None)
+
+
+def write_blocks(to_write, free, done):
+    """
+    Pipeline stage: write blocks into files and free buffers.
+
+    Every finished file is put into 'done' queue with (digest, hashing
+    time) pair, size, time from opening to closing and error message
+    or None. File which is interrupted by error or by end of stage is
+    closed and put with error. End of stage is always passed on.
+    """
+    f = None
+    f_path = None
+    error = None
+    size = 0
+    started = None
+    try:
+        while True:
+            item = to_write.get()
+            if item is None:
+                break
+            f_path, buf, length, last = item
+            if started is None:
+                started = clock()
+            if buf is None:
+                error = error or last
+                last = None
+            else:
+                size += length
+                try:
+                    if f is None and error is None:
+                        f = io.open(f_path, 'wb')
+                    if f is not None:
+                        f.write(memoryview(buf)[:length])
+                except (IOError, OSError) as e:
+                    error = "%s: %s" % (f_path, e)
+                free.put(buf)
+                if not last:
+                    continue
+            try:
+                if f is not None:
+                    f.close()
+            except (IOError, OSError) as e:
+                error = error or "%s: %s" % (f_path, e)
+            done.put((f_path, last, size, clock() - started, error))
+            f = None
+            error = None
+            size = 0
+            started = None
+    except Exception as e:
+        error = error or "%s: %s" % (f_path, e)
+    finally:
+        if started is not None:
+            try:
+                if f is not None:
+                    f.close()
+            except (IOError, OSError):
+                pass
+            done.put((f_path, None, size, clock() - started,
+                      error or "%s: file isn't finished" % f_path))
+        done.put(None)
+
+
+def make_files_hashed(tasks, amount, chk_file, algorithm='md5', workers=1):
+    """
+    Create files with random data by (path, size) tasks and checksums.
+
+    Every file is hashed while it is written, so files aren't read
+    again. Files are taken by 'workers' lanes, every lane has
+    generation, hashing and writing threads connected by bounded
+    queues, so speed of lane is speed of its slowest stage.
+    Checksums are written in order of files completion.
+    """
+    tasks = iter(tasks)
+    tasks_lock = threading.Lock()
+
+    def next_task():
+        with tasks_lock:
+            return next(tasks, None)
+
+    done = queue.Queue()
+    lanes = max(1, min(workers, amount))
+    for lane in range(lanes):
+        free = queue.Queue()
+        for _ in range(QUEUE_DEPTH * 2 + 1):
+            free.put(bytearray(BLOCK_SIZE))
+        to_hash = queue.Queue(QUEUE_DEPTH)
+        to_write = queue.Queue(QUEUE_DEPTH)
+        for target, stage_args in (
+                (generate_blocks, (next_task, free, to_hash)),
+                (hash_blocks, (algorithm, to_hash, to_write)),
+                (write_blocks, (to_write, free, done))):
+            thread = threading.Thread(target=target, args=stage_args)
+            thread.daemon = True
+            thread.start()
     has_fails = False
-    for x in xrange(1, amount):
-        f_name = "%s_%s_%s" % (KILO * k_size,
-                               datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
-                               x)
-        f_path = "%s/%s" % (path, f_name)
-        if os.system("dd if=/dev/urandom of=%s bs=1k count=%s\
- status=none 2>>%s" %
-                     (f_path, k_size, LOG)):
-            has_fails = True
+    finished = 0
+    x = 0
+    with open(LOG, 'a') as log, open(chk_file, 'w') as chk:
+        while finished < lanes:
+            item = done.get()
+            if item is None:
+                finished += 1
+                continue
+            f_path, result, size, latency, error = item
+            x += 1
+            metrics.record('create', latency, size, error)
+            if error:
+                has_fails = True
+                log.write(error + '\n')
+            else:
+                digest, hashing = result
+                metrics.record('hash', hashing, size)
+                chk.write("%s  %s\n" % (digest, f_path))
+            print_progress(x, amount + 1)
+    if has_fails:
+        print("\tFAILED")
+        os.system("cat %s" % LOG)
+    else:
+        print("\tOK")
+
+
+def hash_file(task):
+    """
+    Calculate file digest.
+
+    File is read by big blocks into worker buffer, hashlib releases
+    GIL while it hashes them, so threads hash files in parallel.
+    Return (digest, error message, latency in seconds, size) tuple.
+    """
+    f_path, algorithm = task
+    started = clock()
+    digest = hashlib.new(algorithm)
+    buf = worker_buffer()
+    view = memoryview(buf)
+    total = 0
+    try:
+        with io.open(f_path, 'rb', buffering=0) as f:
+            while True:
+                size = f.readinto(buf)
+                if not size:
+                    break
+                digest.update(view[:size])
+                total += size
+    except (IOError, OSError) as e:
+        return None, "%s: %s" % (f_path, e), clock() - started, total
+    return digest.hexdigest(), None, clock() - started, total
+
+
+def write_checksums(path, chk_file, algorithm='md5', workers=1):
+    """
+    Create checksums file for all files in directory tree.
+
+    Lines have 'md5sum' format, so file can be checked by 'md5sum -c'
+    or by 'sha256sum -c' and 'b2sum -c' for other algorithms.
+    Return True if all files are hashed.
+    """
+    paths = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        paths.extend("%s/%s" % (root, f) for f in sorted(files))
+    has_fails = False
+    pool = make_pool(workers)
+    try:
+        results = pool.imap(hash_file, [(f, algorithm) for f in paths],
+                            chunksize=16)
+        with open(chk_file, 'w') as chk, open(LOG, 'a') as log:
+            for f_path, (digest, error, latency, size) in zip(paths, results):
+                metrics.record('hash', latency, size, error)
+                if error:
+                    has_fails = True
+                    log.write(error + '\n')
+                else:
+                    chk.write("%s  %s\n" % (digest, f_path))
+    finally:
+        pool.close()
+        pool.join()
+    return not has_fails
+
+
+def read_checksums(chk_file):
+    """Return list of (path, digest) pairs from checksums file."""
+    entries = []
+    with open(chk_file) as chk:
+        for line in chk:
+            line = line.rstrip('\n')
+            if line:
+                digest, f_path = line.split(' ', 1)
+                entries.append((f_path[1:], digest))
+    return entries
+
+
+def stat_key(st):
+    """Return (size, mtime in nanoseconds, inode) of file stat."""
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1e9)
+    return st.st_size, mtime, st.st_ino
+
+
+def stat_file(f_path):
+    """Return stat key of file or None if it can't be accessed."""
+    try:
+        return stat_key(os.stat(f_path))
+    except OSError:
+        return None
+
+
+def read_manifest(manifest_file):
+    """
+    Read manifest file.
+
+    Return (algorithm, entries) pair, entries is ordered dict of
+    [digest, size, mtime, inode] lists by paths.
+    """
+    entries = collections.OrderedDict()
+    with open(manifest_file) as f:
+        algorithm = f.readline().split()[-1]
+        for line in f:
+            digest, size, mtime, inode, f_path = line.rstrip('\n').split(
+                ' ', 4)
+            entries[f_path] = [digest, int(size), int(mtime), int(inode)]
+    return algorithm, entries
+
+
+def write_manifest(manifest_file, algorithm, entries):
+    """
+    Write manifest file atomically.
+
+    The first line is '# manifest ALGORITHM', every next line is
+    'DIGEST SIZE MTIME_NS INODE PATH'.
+    """
+    tmp = "%s.%d.tmp" % (manifest_file, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write("# manifest %s\n" % algorithm)
+        for f_path, (digest, size, mtime, inode) in entries.items():
+            f.write("%s %d %d %d %s\n" % (digest, size, mtime, inode, f_path))
+    os.rename(tmp, manifest_file)
+
+
+def build_manifest(chk_file, manifest_file, algorithm='md5', workers=1):
+    """
+    Create manifest with stat data for files from checksums file.
+
+    Return True if all files are accessible.
+    """
+    checksums = read_checksums(chk_file)
+    entries = collections.OrderedDict()
+    has_fails = False
+    pool = make_pool(workers)
+    try:
+        keys = pool.imap(stat_file, [f for f, _ in checksums], chunksize=64)
+        with open(LOG, 'a') as log:
+            for (f_path, digest), key in zip(checksums, keys):
+                if key is None:
+                    has_fails = True
+                    log.write("%s: can't stat file\n" % f_path)
+                else:
+                    entries[f_path] = [digest] + list(key)
+    finally:
+        pool.close()
+        pool.join()
+    write_manifest(manifest_file, algorithm, entries)
+    return not has_fails
+
+
+def prune_manifest(manifest_file, removed):
+    """Drop entries of removed files from manifest."""
+    if not removed:
+        return
+    algorithm, entries = read_manifest(manifest_file)
+    for f_path in removed:
+        entries.pop(f_path, None)
+    write_manifest(manifest_file, algorithm, entries)
+
+
+def scan_dir(task):
+    """
+    Stat files of manifest in one directory by 'os.scandir'.
+
+    'expected' is dict of manifest entries by file names. Return
+    (directory, [(name, stat key)], missed names, latency) tuple.
+    """
+    directory, expected = task
+    started = clock()
+    found = []
+    scandir = getattr(os, 'scandir', None)
+    try:
+        if scandir is not None:
+            names = [(e.name, e) for e in scandir(directory)
+                     if e.name in expected]
+        else:
+            names = [(name, None) for name in os.listdir(directory)
+                     if name in expected]
+    except OSError:
+        names = []
+    for name, entry in names:
+        try:
+            if entry is not None:
+                st = entry.stat()
+            else:
+                st = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        found.append((name, stat_key(st)))
+    seen = set(name for name, _ in found)
+    missed = [name for name in expected if name not in seen]
+    return directory, found, missed, clock() - started
+
+
+def verify_manifest(manifest_file, mode='full', workers=1):
+    """
+    Check files by manifest.
+
+    Directories are scanned in parallel. In 'full' mode all files are
+    hashed again, in 'fast' mode only files which size, mtime or inode
+    differ from manifest. Stat data of files with right digests are
+    saved to manifest, so next fast check skips them.
+    Failed files are written to log. Return (has fails, amount of
+    checked files, amount of hashed files) tuple.
+    """
+    algorithm, entries = read_manifest(manifest_file)
+    by_dir = collections.OrderedDict()
+    for f_path, entry in entries.items():
+        directory, name = os.path.split(f_path)
+        by_dir.setdefault(directory, {})[name] = entry
+    has_fails = False
+    to_hash = []
+    pool = make_pool(workers)
+    try:
+        with open(LOG, 'a') as log:
+            for directory, found, missed, latency in pool.imap_unordered(
+                    scan_dir, by_dir.items()):
+                metrics.record('scan', latency, error=missed)
+                for name in missed:
+                    has_fails = True
+                    log.write("%s/%s: FAILED open or read\n" % (directory,
+                                                                name))
+                for name, key in found:
+                    entry = by_dir[directory][name]
+                    if mode == 'full' or tuple(entry[1:]) != key:
+                        to_hash.append(("%s/%s" % (directory, name), key))
+            results = pool.imap(hash_file,
+                                [(f, algorithm) for f, _ in to_hash],
+                                chunksize=16)
+            for (f_path, key), (digest, error, latency, size) in zip(
+                    to_hash, results):
+                failed = error or digest != entries[f_path][0]
+                metrics.record('verify', latency, size, failed)
+                if failed:
+                    has_fails = True
+                    log.write("%s: FAILED\n" % f_path)
+                else:
+                    entries[f_path][1:] = list(key)
+    finally:
+        pool.close()
+        pool.join()
+    if to_hash:
+        write_manifest(manifest_file, algorithm, entries)
+    return has_fails, len(entries), len(to_hash)
+
+
+def check_files(manifests, mode='full', workers=1):
+    """Run files checking stage for manifests files."""
+    print("Checking files")
+    has_fails = False
+    checked = hashed = 0
+    os.system("cp /dev/null %s" % LOG)
+    metrics.start_stage('verify')
+    for x, manifest_file in enumerate(manifests, 1):
+        fails, files, rehashed = verify_manifest(manifest_file, mode,
+                                                 workers)
+        has_fails = has_fails or fails
+        checked += files
+        hashed += rehashed
+        print_progress(x, len(manifests) + 1)
+    metrics.stop_stage()
 
-        print_progress(x, amount)
     if has_fails:
         print("\tFAILED")
         os.system("cat %s" % LOG)
     else:
         print("\tOK")
+    print("Checked %d files, %d of them are hashed" % (checked, hashed))
+    return not has_fails
+
+
+def save_report(filename):
+    """Save metrics report as JSON, '-' is for stdout."""
+    report = metrics.report()
+    if filename == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Report is saved to %s" % filename)
+
+
+def is_odd_file(name):
+    """Check that file name ends with odd digit."""
+    return name[-1:] in "13579"
+
+
+def scan_tree(path, predicate, dirs, errors):
+    """
+    Yield paths of files in tree which names match predicate.
+
+    Tree is scanned by 'os.scandir' without following symlinks,
+    symlinks are treated as files. Directories are appended to 'dirs'
+    list, parents before children, scan errors to 'errors' list.
+    """
+    scandir = getattr(os, 'scandir', None)
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        dirs.append(directory)
+        try:
+            if scandir is not None:
+                entries = [(e.name, e.is_dir(follow_symlinks=False))
+                           for e in scandir(directory)]
+            else:
+                entries = [(name, os.path.isdir(os.path.join(directory, name))
+                            and not os.path.islink(
+                                os.path.join(directory, name)))
+                           for name in os.listdir(directory)]
+        except OSError as e:
+            errors.append("%s: %s" % (directory, e))
+            continue
+        for name, is_dir in entries:
+            f_path = os.path.join(directory, name)
+            if is_dir:
+                stack.append(f_path)
+            elif predicate(name):
+                yield f_path
+
+
+def unlink_batch(paths):
+    """Remove files, return list of (path, latency, error) tuples."""
+    results = []
+    for f_path in paths:
+        started = clock()
+        try:
+            os.unlink(f_path)
+            results.append((f_path, clock() - started, None))
+        except OSError as e:
+            results.append((f_path, clock() - started,
+                            "%s: %s" % (f_path, e)))
+    return results
+
+
+def delete_files(path, predicate, workers=1, dirs=None):
+    """
+    Remove files in tree which names match predicate.
+
+    Scanned files are removed by batches in pool of 'workers' threads
+    while scanning goes on. Failures are written to log.
+    Return (removed paths, amount of failures) pair.
+    """
+    dirs = [] if dirs is None else dirs
+    errors = []
+    removed = []
+    pool = make_pool(workers)
+    try:
+        with open(LOG, 'a') as log:
+            for results in pool.imap_unordered(
+                    unlink_batch,
+                    batches(scan_tree(path, predicate, dirs, errors),
+                            DELETE_BATCH)):
+                for f_path, latency, error in results:
+                    metrics.record('unlink', latency, error=error)
+                    if error:
+                        errors.append(error)
+                    else:
+                        removed.append(f_path)
+            for error in errors:
+                log.write(error + '\n')
+    finally:
+        pool.close()
+        pool.join()
+    return removed, len(errors)
+
+
+def remove_tree(path, workers=1):
+    """
+    Remove directory tree like 'rm -rf' without shell.
+
+    Files are removed in parallel, then directories from bottom to top.
+    Return (amount of removed files, amount of failures) pair.
+    """
+    dirs = []
+    removed, failures = delete_files(path, lambda name: True, workers, dirs)
+    with open(LOG, 'a') as log:
+        for directory in reversed(dirs):
+            started = clock()
+            try:
+                os.rmdir(directory)
+                metrics.record('rmdir', clock() - started)
+            except OSError as e:
+                metrics.record('rmdir', clock() - started, error=True)
+                failures += 1
+                log.write("%s: %s\n" % (directory, e))
+    return len(removed), failures
+
+
+def copy_data(src, dst, size):
+    """
+    Copy file data between descriptors, return amount of bytes.
+
+    Data are copied inside kernel by 'os.copy_file_range' or by
+    'os.sendfile' if they are available and supported by file system,
+    otherwise through worker buffer.
+    """
+    copied = 0
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    for kernel_copy in (copy_file_range, sendfile):
+        if kernel_copy is None:
+            continue
+        try:
+            while copied < size:
+                if kernel_copy is copy_file_range:
+                    length = copy_file_range(src, dst, size - copied,
+                                             copied, copied)
+                else:
+                    length = sendfile(dst, src, copied, size - copied)
+                if not length:
+                    break
+                copied += length
+            return copied
+        except OSError as e:
+            if copied or e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+    buf = worker_buffer()
+    view = memoryview(buf)
+    src_file = io.open(src, 'rb', buffering=0, closefd=False)
+    while True:
+        length = src_file.readinto(buf)
+        if not length:
+            return copied
+        written = 0
+        while written < length:
+            written += os.write(dst, view[written:length])
+        copied += length
+
+
+def copy_file(task):
+    """
+    Copy one file.
+
+    'hardlink' and 'reflink' modes fall back to data copy when file
+    system doesn't support them.
+    Return (operation, amount of copied bytes, error message, latency
+    in seconds) tuple, operation is 'copy', 'hardlink' or 'reflink'.
+    """
+    src, dst, mode = task
+    started = clock()
+    op, size, error = copy_file_data(src, dst, mode)
+    return op, size, error, clock() - started
+
+
+def copy_file_data(src, dst, mode):
+    """
+    Copy one file.
+
+    Return (operation, amount of copied bytes, error message) tuple,
+    linked and cloned files have no copied bytes.
+    """
+    try:
+        if mode == 'hardlink':
+            try:
+                os.link(src, dst)
+                return 'hardlink', 0, None
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            st = os.fstat(src_fd)
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             st.st_mode & 0o777)
+            try:
+                if mode == 'reflink':
+                    try:
+                        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                        return 'reflink', 0, None
+                    except (IOError, OSError) as e:
+                        if e.errno not in UNSUPPORTED_ERRNOS:
+                            raise
+                return 'copy', copy_data(src_fd, dst_fd, st.st_size), None
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    except (IOError, OSError) as e:
+        return 'copy', 0, "%s: %s" % (src, e)
+
+
+def copy_tree(src, dst, mode='copy', workers=1):
+    """
+    Copy directory tree like 'cp -R', files are copied in parallel.
+
+    Directories and symlinks are created first, then files are copied
+    by pool of 'workers' threads. Linked and cloned files are recorded
+    as own operations without data bytes. Errors are written to log.
+    Return (amount of files, amount of copied bytes, has fails) tuple.
+    """
+    tasks = []
+    has_fails = False
+    with open(LOG, 'a') as log:
+        for root, dirs, files in os.walk(src):
+            target = os.path.normpath(
+                os.path.join(dst, os.path.relpath(root, src)))
+            started = clock()
+            try:
+                os.mkdir(target)
+                metrics.record('mkdir', clock() - started)
+            except OSError as e:
+                metrics.record('mkdir', clock() - started, error=True)
+                has_fails = True
+                log.write("%s: %s\n" % (target, e))
+                dirs[:] = []
+                continue
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    started = clock()
+                    try:
+                        os.symlink(os.readlink(path),
+                                   os.path.join(target, name))
+                        metrics.record('symlink', clock() - started)
+                    except OSError as e:
+                        metrics.record('symlink', clock() - started,
+                                       error=True)
+                        has_fails = True
+                        log.write("%s: %s\n" % (path, e))
+                elif name in files:
+                    tasks.append((path, os.path.join(target, name), mode))
+        pool = make_pool(workers)
+        try:
+            copied = 0
+            for op, size, error, latency in pool.imap_unordered(
+                    copy_file, tasks, chunksize=16):
+                metrics.record(op, latency, size, error)
+                copied += size
+                if error:
+                    has_fails = True
+                    log.write(error + '\n')
+        finally:
+            pool.close()
+            pool.join()
+    return len(tasks), copied, has_fails
+
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Execute test task.")
+    parser.add_argument('-w', '--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="amount of workers for files generation "
+                             "and checksums (default amount of CPUs)")
+    parser.add_argument('-p', '--processes', action='store_true',
+                        help="use processes instead of threads as workers")
+    parser.add_argument('-a', '--algorithm', default='md5',
+                        help="checksums algorithm: md5, sha256, blake2b or "
+                             "other hashlib algorithm (default md5)")
+    parser.add_argument('-c', '--copy-mode', choices=COPY_MODES,
+                        default='copy',
+                        help="copy files data, make hardlinks or make "
+                             "reflinks where file system supports them "
+                             "(default copy)")
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help="hash files while they are generated instead "
+                             "of reading them again, workers are threads")
+    parser.add_argument('--workload', metavar='JSON_FILE',
+                        help="workload spec with 'dirs', 'fanout', "
+                             "'depth', 'files', 'size' and 'seed' keys, "
+                             "options below override it")
+    parser.add_argument('--dirs', type=int,
+                        help="amount of top directories (default 5)")
+    parser.add_argument('--fanout', type=int,
+                        help="amount of subdirectories in every directory "
+                             "(default 0)")
+    parser.add_argument('--depth', type=int,
+                        help="nesting levels of subdirectories (default 0)")
+    parser.add_argument('--files', type=int,
+                        help="amount of files in every deepest directory "
+                             "(default 1000)")
+    parser.add_argument('--size',
+                        help="files size distribution: dir (N kilobytes in "
+                             "dir_N), fixed:SIZE, uniform:MIN:MAX or "
+                             "lognormal:MEDIAN:SIGMA[:MAX], sizes like "
+                             "512, 4K, 1M or 2G (default dir)")
+    parser.add_argument('--seed', type=int,
+                        help="seed for random files sizes (default 0)")
+    parser.add_argument('-r', '--report', metavar='JSON_FILE',
+                        default='report.json',
+                        help="save latency percentiles, ops/s and MB/s of "
+                             "every operation by stages in JSON_FILE ('-' "
+                             "for stdout, default report.json)")
+    parser.add_argument('-v', '--verify', choices=VERIFY_MODES,
+                        default='full',
+                        help="hash all files or only files which stat data "
+                             "differ from manifest (default full)")
+    parser.add_argument('--reverify', action='store_true',
+                        help="only check files of previous launch by "
+                             "manifests and update their stat data")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("amount of workers must be positive")
+    if args.stream and args.processes:
+        parser.error("stream hashing works with threads only, -s can't "
+                     "be used with -p")
+    try:
+        hashlib.new(args.algorithm)
+    except ValueError:
+        parser.error("unsupported checksums algorithm '%s'" % args.algorithm)
+    try:
+        spec = load_workload(args.workload, dirs=args.dirs,
+                             fanout=args.fanout, depth=args.depth,
+                             files=args.files, size=args.size,
+                             seed=args.seed)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+    top_dirs = range(1, spec['dirs'] + 1)
+
+    if args.reverify:
+        manifests = sorted(glob.glob('dir_*.manifest'))
+        if not manifests:
+            parser.error("no manifests of previous launch")
+        os.system("cp /dev/null %s" % LOG)
+        is_ok = check_files(manifests, args.verify, args.workers)
+        save_report(args.report)
+        sys.exit(0 if is_ok else 1)
 
     print("Removing dirs and files from the previous launch")
     os.system("rm -rf dir* %s" % LOG)
 
     print("Creating original directories")
     os.system("cp /dev/null %s" % LOG)
-    make_dirs(5)
-    for x in xrange(1, 6):
-        print("Generating files in ./dir_%s with %sK size" % (x, x))
+    metrics.start_stage('make_dirs')
+    make_dirs(spec)
+    metrics.stop_stage()
+    amount = files_amount(spec)
+    metrics.start_stage('generate')
+    for x in top_dirs:
+        if spec['size'] == 'dir':
+            print("Generating %s files in ./dir_%s with %sK size" % (
+                amount, x, x))
+        else:
+            print("Generating %s files in ./dir_%s with %s size" % (
+                amount, x, spec['size']))
+        os.system("cp /dev/null %s" % LOG)
+        if args.stream:
+            make_files_hashed(file_tasks(spec, x), amount, "dir_%s.chk" % x,
+                              args.algorithm, args.workers)
+        else:
+            make_files(file_tasks(spec, x), amount, args.workers,
+                       args.processes)
+    metrics.stop_stage()
+
+    if not args.stream:
+        print("Creating checksums for created files")
+        metrics.start_stage('checksum')
         os.system("cp /dev/null %s" % LOG)
-        make_files("./dir_%s" % x, x)
+        has_fails = False
+        for x in top_dirs:
+            if not write_checksums("./dir_%s" % x, "dir_%s.chk" % x,
+                                   args.algorithm, args.workers):
+                has_fails = True
+            print_progress(x, len(top_dirs) + 1)
+        metrics.stop_stage()
+        if has_fails:
+            print("\tFAILED")
+            os.system("cat %s" % LOG)
+        else:
+            print("\tOK")
 
-    print("Creating checksums for created files")
+    print("Creating manifests for created files")
     os.system("cp /dev/null %s" % LOG)
+    metrics.start_stage('manifest')
     has_fails = False
-    for x in xrange(1, 6):
-        if os.system("md5sum ./dir_%s/* 1>dir_%s.chk 2>>%s" % (x, x, LOG)):
+    for x in top_dirs:
+        if not build_manifest("dir_%s.chk" % x, "dir_%s.manifest" % x,
+                              args.algorithm, args.workers):
             has_fails = True
-        print_progress(x, 6)
+        print_progress(x, len(top_dirs) + 1)
+    metrics.stop_stage()
     if has_fails:
         print("\tFAILED")
         os.system("cat %s" % LOG)
@@ -94,16 +1297,28 @@ if __name__ == '__main__':
     print("Copying original folders to %s" % copy_dir)
     has_fails = False
     os.system("cp /dev/null %s" % LOG)
-    for x in xrange(1, 6):
-        if os.system("cp -R ./dir_%s ./%s/ 2>>%s" % (x, copy_dir, LOG)):
-            has_fails = True
-        print_progress(x, 6)
+    metrics.start_stage('copy')
+    started = time.time()
+    copied_files = copied_bytes = 0
+    for x in top_dirs:
+        files, size, fails = copy_tree("./dir_%s" % x,
+                                       "./%s/dir_%s" % (copy_dir, x),
+                                       args.copy_mode, args.workers)
+        copied_files += files
+        copied_bytes += size
+        has_fails = has_fails or fails
+        print_progress(x, len(top_dirs) + 1)
+    metrics.stop_stage()
 
     if has_fails:
         print("\tFAILED")
         os.system("cat %s" % LOG)
     else:
         print("\tOK")
+    elapsed = max(time.time() - started, 1e-6)
+    print("Copied %d files, %.1f MB in %.2f s: %.1f files/s, %.1f MB/s" % (
+        copied_files, copied_bytes / 1e6, elapsed, copied_files / elapsed,
+        copied_bytes / 1e6 / elapsed))
 
     move_dir = "dir_mv"
     if os.system("mkdir %s" % move_dir):
@@ -112,8 +1327,17 @@ if __name__ == '__main__':
     print("Moving %s directory to %s" % (copy_dir, move_dir))
     has_fails = False
     os.system("cp /dev/null %s" % LOG)
-    if os.system("mv ./%s ./%s/ 2>%s" % (copy_dir, move_dir, LOG)):
+    metrics.start_stage('move')
+    started = clock()
+    try:
+        os.rename(copy_dir, os.path.join(move_dir, copy_dir))
+        metrics.record('rename', clock() - started)
+    except OSError as e:
+        metrics.record('rename', clock() - started, error=True)
         has_fails = True
+        with open(LOG, 'a') as log:
+            log.write("%s: %s\n" % (copy_dir, e))
+    metrics.stop_stage()
     print_progress(99, 100)
 
     if has_fails:
@@ -125,26 +1349,40 @@ if __name__ == '__main__':
     print("Removing original directories")
     has_fails = False
     os.system("cp /dev/null %s" % LOG)
-    for x in xrange(1, 6):
-        if os.system("rm -rf dir_%s 2>>%s" % (x, LOG)):
-            has_fails = False
-        print_progress(x, 6)
+    metrics.start_stage('remove_dirs')
+    removed_files = failures = 0
+    for x in top_dirs:
+        files, fails = remove_tree("dir_%s" % x, args.workers)
+        removed_files += files
+        failures += fails
+        print_progress(x, len(top_dirs) + 1)
+    metrics.stop_stage()
 
-    if has_fails:
+    if failures:
         print("\tFAILED")
         os.system("cat %s" % LOG)
     else:
         print("\tOK")
+    print("Removed %d files, %d failures" % (removed_files, failures))
 
     print("Creating symlinks for directories in ./%s/%s/"
           % (move_dir, copy_dir))
     has_fails = False
     os.system("cp /dev/null %s" % LOG)
-    for x in xrange(1, 6):
-        if os.system("ln -s ./%s/%s/dir_%s dir_%s 2>>%s" %
-                     (move_dir, copy_dir, x, x, LOG)):
-            has_fails = True
-        print_progress(x, 6)
+    metrics.start_stage('symlink')
+    with open(LOG, 'a') as log:
+        for x in top_dirs:
+            started = clock()
+            try:
+                os.symlink("./%s/%s/dir_%s" % (move_dir, copy_dir, x),
+                           "dir_%s" % x)
+                metrics.record('symlink', clock() - started)
+            except OSError as e:
+                metrics.record('symlink', clock() - started, error=True)
+                has_fails = True
+                log.write("dir_%s: %s\n" % (x, e))
+            print_progress(x, len(top_dirs) + 1)
+    metrics.stop_stage()
 
     if has_fails:
         print("\tFAILED")
@@ -152,36 +1390,31 @@ if __name__ == '__main__':
     else:
         print("\tOK")
 
-    print("Checking files")
-    has_fails = False
-    os.system("cp /dev/null %s" % LOG)
-    for x in xrange(1, 6):
-        if os.system("md5sum -c --quiet dir_%s.chk 2>>%s" % (x, LOG)):
-            has_fails = True
-        print_progress(x, 6)
-
-    if has_fails:
-        print("\tFAILED")
-        os.system("cat %s" % LOG)
-    else:
-        print("\tOK")
+    check_files(["dir_%s.manifest" % x for x in top_dirs], args.verify,
+                args.workers)
 
     print("Removing ood files from even folders")
-    has_fails = False
     os.system("cp /dev/null %s" % LOG)
-    # os.system("rm ./%s/%s/dir_{2,4}/*{1,3,5,7,9}" % (move_dir, copy_dir))
-    # This works from bash but doesn't work from Python in Linux
-    for x in [2, 4]:
-        for root, _, files in os.walk("./%s/%s/dir_%s" %
-                                      (move_dir, copy_dir, x)):
-            for f in files:
-                if f[-1] in "13579":
-                    if os.system("rm %s/%s 2>>%s" % (root, f, LOG)):
-                        has_fails = True
+    metrics.start_stage('remove_odd')
+    even_dirs = top_dirs[1::2]
+    removed_files = failures = 0
+    for n, x in enumerate(even_dirs, 1):
+        top = "./%s/%s/dir_%s" % (move_dir, copy_dir, x)
+        removed, fails = delete_files(top, is_odd_file, args.workers)
+        removed_files += len(removed)
+        failures += fails
+        prune_manifest("dir_%s.manifest" % x, set(
+            "./dir_%s/%s" % (x, os.path.relpath(f_path, top))
+            for f_path in removed))
+        print_progress(n, len(even_dirs) + 1)
+    metrics.stop_stage()
     print_progress(99, 100)
 
-    if has_fails:
+    if failures:
         print("\tFAILED")
         os.system("cat %s" % LOG)
     else:
         print("\tOK")
+    print("Removed %d files, %d failures" % (removed_files, failures))
+
+    save_report(args.report)
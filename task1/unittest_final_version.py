@@ -0,0 +1,420 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Unit tests for final_version.py, file system tests run in temporary dirs."""
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+import unittest
+import subprocess
+import final_version
+from final_version import (LatencyHistogram, parse_size, parse_size_spec,
+                           load_workload, write_checksums, read_checksums,
+                           build_manifest, read_manifest, prune_manifest,
+                           verify_manifest, make_files, make_files_hashed,
+                           copy_tree, is_odd_file, delete_files, remove_tree)
+
+
+MTIME = 1000000000
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+
+    def testBucket_small(self):
+        histogram = LatencyHistogram()
+        for value in (0, 1, 64, 127):
+            self.assertEqual(histogram.bucket_value(histogram.bucket(value)), value,
+                             "small values must be kept exactly")
+
+    def testBucket_precision(self):
+        histogram = LatencyHistogram()
+        for value in (128, 129, 1000, 123456, 10 ** 9, 3 * 10 ** 11):
+            index = histogram.bucket(value)
+            high = histogram.bucket_value(index)
+            self.assertGreaterEqual(high, value)
+            self.assertLess(histogram.bucket_value(index - 1), value,
+                            "%d must be in the lowest possible bucket" % value)
+            self.assertLess((high - value) / float(value), 1.0 / 64)
+
+    def testPercentile(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.percentile(50), "empty histogram has no percentiles")
+        for ms in range(1, 101):
+            histogram.record(ms / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.percentile(50), 0.050, delta=0.050 / 64)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.099 / 64)
+        self.assertEqual(histogram.percentile(100), histogram.max / 1e9,
+                         "percentile can't exceed maximum")
+        self.assertAlmostEqual(histogram.percentile(0), 0.001, delta=0.001 / 64)
+
+
+class WorkloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_json(self, data):
+        fname = os.path.join(self.tmp_dir, 'workload.json')
+        with open(fname, 'w') as f:
+            json.dump(data, f)
+        return fname
+
+    def testParseSize(self):
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('4k'), 4096)
+        self.assertEqual(parse_size('1.5M'), 1536 * 1024)
+        self.assertRaises(ValueError, parse_size, '-1K')
+        self.assertRaises(ValueError, parse_size, 'big')
+
+    def testParseSizeSpec(self):
+        self.assertEqual(parse_size_spec('dir'), ('dir', ()))
+        self.assertEqual(parse_size_spec('fixed:4K'), ('fixed', (4096,)))
+        self.assertEqual(parse_size_spec('uniform:1K:2K'), ('uniform', (1024, 2048)))
+        self.assertEqual(parse_size_spec('lognormal:64K:1.5:1M'),
+                         ('lognormal', (65536, 1.5, 1048576)))
+
+    def testParseSizeSpec_wrong(self):
+        for spec in ('dir:1', 'fixed', 'fixed:x', 'uniform:2K:1K', 'lognormal:0:1',
+                     'lognormal:1K:-1', 'normal:1K'):
+            self.assertRaises(ValueError, parse_size_spec, spec)
+
+    def testLoadWorkload(self):
+        spec = load_workload(self.write_json({'dirs': 2, 'files': 10, 'size': 'fixed:1K'}), files=3)
+        self.assertEqual((spec['dirs'], spec['files'], spec['size']), (2, 3, 'fixed:1K'),
+                         "options must override file and defaults")
+
+    def testLoadWorkload_wrong(self):
+        self.assertRaises(ValueError, load_workload, self.write_json({'dir': 2}))
+        self.assertRaises(ValueError, load_workload, dirs=0)
+        self.assertRaises(ValueError, load_workload, files=-1)
+        self.assertRaises(ValueError, load_workload, depth=1.5)
+        self.assertRaises(ValueError, load_workload, size='uniform:1')
+        self.assertRaises(ValueError, load_workload, self.write_json({'size': 4096}))
+        self.assertRaises(ValueError, load_workload, files=True)
+        self.assertRaises(ValueError, load_workload, self.write_json({'dirs': True}))
+
+
+class WorkDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        final_version.metrics.start_stage('test')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def read_log(self):
+        with open(final_version.LOG) as log:
+            return log.read()
+
+
+class MakeFilesTestCase(WorkDirTestCase):
+
+    def setUp(self):
+        WorkDirTestCase.setUp(self)
+        os.mkdir('dir_1')
+        self.tasks = [("./dir_1/file_%d" % n, size) for n, size in
+                      enumerate((0, 1000, 1000, final_version.BLOCK_SIZE + 1), 1)]
+
+    def assertCreated(self, tasks):
+        data = []
+        for f_path, size in tasks:
+            with open(f_path, 'rb') as f:
+                data.append(f.read())
+            self.assertEqual(len(data[-1]), size, "%s must have %d bytes" % (f_path, size))
+        return data
+
+    def testMakeFiles_threads(self):
+        make_files(self.tasks, len(self.tasks), workers=3)
+        data = self.assertCreated(self.tasks)
+        self.assertNotEqual(data[1], data[2], "files must have random data")
+        create = final_version.metrics.stage['ops']['create']
+        self.assertEqual((create['histogram'].count, create['errors']), (4, 0))
+        self.assertEqual(create['bytes'], sum(size for _, size in self.tasks))
+
+    def testMakeFiles_processes(self):
+        make_files(self.tasks, len(self.tasks), workers=2, processes=True)
+        self.assertCreated(self.tasks)
+
+    def testMakeFiles_error(self):
+        tasks = self.tasks + [("./missing/file_1", 10)]
+        make_files(tasks, len(tasks), workers=2)
+        self.assertCreated(self.tasks)
+        self.assertIn("./missing/file_1", self.read_log())
+        self.assertEqual(final_version.metrics.stage['ops']['create']['errors'], 1)
+
+
+class ChecksumsTestCase(WorkDirTestCase):
+
+    def setUp(self):
+        WorkDirTestCase.setUp(self)
+        os.makedirs('dir_1/sub')
+        self.files = {}
+        for n, f_path in enumerate(("./dir_1/file_1", "./dir_1/sub/file 2", "./dir_1/empty")):
+            self.files[f_path] = os.urandom(1000 * n)
+            with open(f_path, 'wb') as f:
+                f.write(self.files[f_path])
+
+    def testWriteChecksums(self):
+        for algorithm in ('md5', 'sha256'):
+            self.assertTrue(write_checksums('./dir_1', 'dir_1.chk', algorithm, workers=2))
+            checksums = read_checksums('dir_1.chk')
+            self.assertListEqual([f_path for f_path, _ in checksums], sorted(self.files))
+            for f_path, digest in checksums:
+                self.assertEqual(digest, hashlib.new(algorithm, self.files[f_path]).hexdigest())
+
+    def testWriteChecksums_md5sum(self):
+        write_checksums('./dir_1', 'dir_1.md5')
+        try:
+            with open(os.devnull, 'w') as devnull:
+                code = subprocess.call(['md5sum', '-c', '--quiet', 'dir_1.md5'],
+                                       stdout=devnull, stderr=devnull)
+        except OSError:
+            self.skipTest("md5sum isn't available")
+        self.assertEqual(code, 0, "checksums file must be checked by 'md5sum -c'")
+
+    def testWriteChecksums_error(self):
+        os.symlink('missing', 'dir_1/broken')
+        self.assertFalse(write_checksums('./dir_1', 'dir_1.md5'))
+        self.assertEqual(len(read_checksums('dir_1.md5')), 3, "readable files must be hashed")
+        self.assertIn("./dir_1/broken", self.read_log())
+
+
+class PipelineTestCase(WorkDirTestCase):
+
+    def setUp(self):
+        WorkDirTestCase.setUp(self)
+        os.mkdir('dir_1')
+        self.tasks = [("./dir_1/file_%d" % n, size) for n, size in
+                      enumerate((0, 1000, final_version.BLOCK_SIZE * 2 + 1), 1)]
+        self.fill_random = final_version.fill_random
+
+    def tearDown(self):
+        final_version.fill_random = self.fill_random
+        WorkDirTestCase.tearDown(self)
+
+    def testMakeFilesHashed(self):
+        make_files_hashed(self.tasks, len(self.tasks), 'dir_1.md5', workers=2)
+        checksums = dict(read_checksums('dir_1.md5'))
+        self.assertEqual(len(checksums), 3)
+        for f_path, size in self.tasks:
+            with open(f_path, 'rb') as f:
+                data = f.read()
+            self.assertEqual(len(data), size)
+            self.assertEqual(checksums[f_path], hashlib.md5(data).hexdigest(),
+                             "digest of written data must be saved")
+
+    def testMakeFilesHashed_generationError(self):
+        def fill_random(buf, size):
+            raise OSError(errno.EIO, "injected error")
+        final_version.fill_random = fill_random
+        make_files_hashed(self.tasks, len(self.tasks), 'dir_1.md5', workers=2)
+        self.assertListEqual(read_checksums('dir_1.md5'), [],
+                             "failed files mustn't be in checksums")
+        self.assertIn("injected error", self.read_log())
+
+    def testMakeFilesHashed_tasksError(self):
+        def tasks():
+            yield self.tasks[1]
+            raise ValueError("broken tasks")
+        make_files_hashed(tasks(), 2, 'dir_1.md5', workers=1)
+        self.assertIn("broken tasks", self.read_log())
+        self.assertEqual(len(read_checksums('dir_1.md5')), 1,
+                         "files before error must be finished")
+
+
+class CopyTreeTestCase(WorkDirTestCase):
+
+    def setUp(self):
+        WorkDirTestCase.setUp(self)
+        os.makedirs('src/sub')
+        self.files = {'a': os.urandom(3000),
+                      'sub/b': os.urandom(final_version.BLOCK_SIZE + 10)}
+        for name, data in self.files.items():
+            with open(os.path.join('src', name), 'wb') as f:
+                f.write(data)
+        os.symlink('a', 'src/link')
+        os.symlink('sub', 'src/sub_link')
+        self.size = sum(len(data) for data in self.files.values())
+        self.patched = []
+
+    def tearDown(self):
+        for name, value in reversed(self.patched):
+            if value is None:
+                delattr(os, name)
+            else:
+                setattr(os, name, value)
+        WorkDirTestCase.tearDown(self)
+
+    def unsupported(self, name, error=errno.ENOSYS):
+        def call(*args):
+            raise OSError(error, "unsupported")
+        self.patched.append((name, getattr(os, name, None)))
+        setattr(os, name, call)
+
+    def assertCopied(self):
+        for name, data in self.files.items():
+            with open(os.path.join('dst', name), 'rb') as f:
+                self.assertEqual(f.read(), data, "%s data must be copied" % name)
+        for name, target in (('link', 'a'), ('sub_link', 'sub')):
+            path = os.path.join('dst', name)
+            self.assertTrue(os.path.islink(path), "%s must be copied as symlink" % name)
+            self.assertEqual(os.readlink(path), target)
+
+    def testCopyTree(self):
+        self.assertEqual(copy_tree('src', 'dst', workers=2), (2, self.size, False))
+        self.assertCopied()
+        ops = final_version.metrics.stage['ops']
+        self.assertEqual(ops['copy']['bytes'], self.size)
+        self.assertEqual(ops['symlink']['histogram'].count, 2)
+
+    def testCopyTree_bufferCopy(self):
+        self.unsupported('copy_file_range')
+        self.unsupported('sendfile')
+        self.assertEqual(copy_tree('src', 'dst'), (2, self.size, False),
+                         "data must be copied through buffer without kernel copy")
+        self.assertCopied()
+
+    def testCopyTree_hardlink(self):
+        self.assertEqual(copy_tree('src', 'dst', 'hardlink'), (2, 0, False),
+                         "linked files have no copied bytes")
+        self.assertCopied()
+        self.assertEqual(os.stat('dst/a').st_ino, os.stat('src/a').st_ino)
+        ops = final_version.metrics.stage['ops']
+        self.assertEqual((ops['hardlink']['histogram'].count, ops['hardlink']['bytes']), (2, 0))
+        self.assertNotIn('copy', ops)
+
+    def testCopyTree_hardlinkFallback(self):
+        self.unsupported('link', errno.EXDEV)
+        self.assertEqual(copy_tree('src', 'dst', 'hardlink'), (2, self.size, False),
+                         "data must be copied when links aren't supported")
+        self.assertCopied()
+        self.assertNotEqual(os.stat('dst/a').st_ino, os.stat('src/a').st_ino)
+
+    def testCopyTree_reflink(self):
+        files, size, fails = copy_tree('src', 'dst', 'reflink')
+        self.assertCopied()
+        ops = final_version.metrics.stage['ops']
+        self.assertEqual((files, fails), (2, False))
+        self.assertEqual(size, ops.get('copy', {'bytes': 0})['bytes'],
+                         "only data copied without cloning are counted")
+
+    def testCopyTree_existingTarget(self):
+        os.mkdir('dst')
+        self.assertEqual(copy_tree('src', 'dst'), (0, 0, True))
+        self.assertIn('dst', self.read_log())
+
+
+class DeleteTestCase(WorkDirTestCase):
+
+    def setUp(self):
+        WorkDirTestCase.setUp(self)
+        os.makedirs('outside')
+        self.files = []
+        for d in ('tree', 'tree/sub_1', 'tree/sub_1/sub_2'):
+            if not os.path.isdir(d):
+                os.mkdir(d)
+            for n in range(1, 5):
+                self.files.append("%s/file_%d" % (d, n))
+                open(self.files[-1], 'w').close()
+        os.symlink(os.path.abspath('outside'), 'tree/link_3')
+        open('outside/file_1', 'w').close()
+
+    def testDeleteFiles_odd(self):
+        removed, failures = delete_files('tree', is_odd_file, workers=2)
+        odd = [f for f in self.files if is_odd_file(f)] + ['tree/link_3']
+        self.assertListEqual(sorted(removed), sorted(odd))
+        self.assertEqual(failures, 0)
+        for f_path in self.files:
+            self.assertEqual(os.path.exists(f_path), not is_odd_file(f_path))
+        self.assertTrue(os.path.exists('outside/file_1'), "symlinks mustn't be followed")
+
+    def testRemoveTree(self):
+        self.assertEqual(remove_tree('tree', workers=2), (len(self.files) + 1, 0))
+        self.assertFalse(os.path.exists('tree'))
+        self.assertTrue(os.path.exists('outside/file_1'), "symlinks mustn't be followed")
+        ops = final_version.metrics.stage['ops']
+        self.assertEqual(ops['rmdir']['histogram'].count, 3, "directories must be removed bottom-up")
+
+    def testRemoveTree_failures(self):
+        self.assertEqual(remove_tree('missing'), (0, 2), "scan and rmdir failures must be counted")
+        self.assertIn("missing", self.read_log())
+
+
+class ManifestTestCase(WorkDirTestCase):
+
+    def setUp(self):
+        WorkDirTestCase.setUp(self)
+        os.mkdir('dir_1')
+        self.files = []
+        for n in range(1, 6):
+            self.files.append("./dir_1/file_%d" % n)
+            with open(self.files[-1], 'wb') as f:
+                f.write(os.urandom(1000 * n))
+            os.utime(self.files[-1], (MTIME, MTIME))
+        write_checksums('./dir_1', 'dir_1.md5')
+        build_manifest('dir_1.md5', 'dir_1.manifest')
+
+    def corrupt(self, f_path, keep_mtime=False):
+        with open(f_path, 'r+b') as f:
+            data = f.read(1)
+            f.seek(0)
+            f.write(bytes(bytearray([(ord(data) + 1) % 256])))
+        mtime = MTIME if keep_mtime else MTIME + 10
+        os.utime(f_path, (mtime, mtime))
+
+    def testBuildManifest(self):
+        algorithm, entries = read_manifest('dir_1.manifest')
+        self.assertEqual(algorithm, 'md5')
+        self.assertListEqual(list(entries), self.files)
+        self.assertEqual(entries[self.files[1]][1], 2000, "size must be saved")
+
+    def testVerifyManifest_full(self):
+        self.assertEqual(verify_manifest('dir_1.manifest', 'full'), (False, 5, 5))
+        self.assertEqual(verify_manifest('dir_1.manifest', 'full', workers=2), (False, 5, 5),
+                         "full mode must hash all files")
+
+    def testVerifyManifest_fast(self):
+        self.assertEqual(verify_manifest('dir_1.manifest', 'fast'), (False, 5, 0),
+                         "unchanged files mustn't be hashed")
+        os.utime(self.files[0], (MTIME + 10, MTIME + 10))
+        self.assertEqual(verify_manifest('dir_1.manifest', 'fast'), (False, 5, 1),
+                         "only touched file must be hashed")
+        self.assertEqual(verify_manifest('dir_1.manifest', 'fast'), (False, 5, 0),
+                         "stat data of checked file must be saved to manifest")
+
+    def testVerifyManifest_corrupted(self):
+        self.corrupt(self.files[2])
+        self.assertEqual(verify_manifest('dir_1.manifest', 'fast'), (True, 5, 1))
+        self.assertEqual(verify_manifest('dir_1.manifest', 'fast'), (True, 5, 1),
+                         "stat data of failed file mustn't be saved")
+        self.assertIn("%s: FAILED" % self.files[2], self.read_log())
+
+    def testVerifyManifest_sameStat(self):
+        self.corrupt(self.files[2], keep_mtime=True)
+        if verify_manifest('dir_1.manifest', 'fast')[0]:
+            self.skipTest("file system doesn't keep modification time")
+        self.assertEqual(verify_manifest('dir_1.manifest', 'full'), (True, 5, 5),
+                         "full mode must find changes with the same stat data")
+
+    def testVerifyManifest_missed(self):
+        os.remove(self.files[4])
+        self.assertEqual(verify_manifest('dir_1.manifest', 'fast'), (True, 5, 0))
+        prune_manifest('dir_1.manifest', [self.files[4]])
+        self.assertListEqual(list(read_manifest('dir_1.manifest')[1]), self.files[:4])
+        self.assertEqual(verify_manifest('dir_1.manifest', 'fast'), (False, 4, 0),
+                         "removed files mustn't be checked after pruning")
+
+
+if __name__ == '__main__':
+    unittest.main()
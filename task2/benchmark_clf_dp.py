@@ -0,0 +1,330 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Module provide benchmarks for classifiers data processor.
+
+Startup benchmark measures cold start time of 'clf_dp' module import
+and of command line calls which stop on arguments or files validation.
+Scale benchmark measures 'calculate_quality' on synthetic data of
+different size, classes ratio and amount of classifiers and on data
+files from 'data' directory as real-world baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLF_DP = os.path.join(HERE, 'clf_dp.py')
+BASELINE_FILES = [os.path.join(HERE, 'data', name) for name in (
+    'NaiveBayes_pred.csv', 'LogisticRegression_pred.csv', 'test_labels.csv')]
+GENERATE_ROWS = 1000000
+wall_time = getattr(time, 'perf_counter', time.time)
+
+
+def startup_cases():
+    """
+    Return startup cases as dict of commands by names.
+
+    'import_with_sklearn' case shows startup time with 'sklearn.metrics'
+    import which was made by 'clf_dp' module before, it is skipped when
+    scikit-learn isn't installed.
+    """
+    missing = os.path.join(HERE, 'missing.csv')
+    cases = {
+        'import': [sys.executable, '-c', 'import clf_dp'],
+        'cli_help': [sys.executable, CLF_DP, '-h'],
+        'cli_missing_file': [sys.executable, CLF_DP, missing, missing],
+    }
+    try:
+        import sklearn
+    except ImportError:
+        pass
+    else:
+        cases['import_with_sklearn'] = [
+            sys.executable, '-c', 'import sklearn.metrics, clf_dp']
+    return cases
+
+
+def time_command(command, repeat):
+    """Run command 'repeat' times, return list of wall times in seconds."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            started = wall_time()
+            subprocess.call(command, cwd=HERE, stdout=devnull,
+                            stderr=devnull)
+            times.append(wall_time() - started)
+    return times
+
+
+def startup_benchmark(repeat=10):
+    """
+    Measure cold start time of every startup case.
+
+    Return dict with minimum, median and maximum times per case.
+    """
+    results = {}
+    for name, command in sorted(startup_cases().items()):
+        times = sorted(time_command(command, repeat))
+        results[name] = {'min': times[0], 'median': times[len(times) // 2],
+                         'max': times[-1], 'repeat': repeat}
+    return results
+
+
+def case_name(rows, positive_ratio, classifiers):
+    """Return synthetic case name."""
+    return "rows%d_pos%g_clf%d" % (rows, positive_ratio, classifiers)
+
+
+def generate_case(data_dir, rows, positive_ratio, classifiers, seed=0):
+    """
+    Generate synthetic classifiers and answers CSV files.
+
+    Classifiers scores have 4 decimals, every next classifier separates
+    classes better. Data are written by chunks, so memory usage doesn't
+    depend on amount of rows. Answers and every classifier are drawn
+    from their own random streams, so files which exist already are
+    reused and only missed ones are generated with the same data.
+    Return list of files with answers file at the end.
+    """
+    case_dir = os.path.join(data_dir, "rows%d_pos%g_seed%d" % (
+        rows, positive_ratio, seed))
+    if not os.path.isdir(case_dir):
+        os.makedirs(case_dir)
+    answers = os.path.join(case_dir, 'answers.csv')
+    files = [os.path.join(case_dir, 'clf_%03d.csv' % i)
+             for i in range(classifiers)]
+    missed = [i for i, f in enumerate(files) if not os.path.exists(f)]
+    has_answers = os.path.exists(answers)
+    if not missed and has_answers:
+        return files + [answers]
+    labels_rnd = np.random.RandomState(seed)
+    rnds = [np.random.RandomState([seed, i]) for i in missed]
+    outputs = [open(files[i] + '.tmp', 'w') for i in missed]
+    labels_output = None if has_answers else open(answers + '.tmp', 'w')
+    try:
+        for start in range(0, rows, GENERATE_ROWS):
+            size = min(GENERATE_ROWS, rows - start)
+            labels = (labels_rnd.rand(size) < positive_ratio).astype(
+                np.uint8)
+            if labels_output is not None:
+                np.savetxt(labels_output, labels, fmt='%d')
+            for i, rnd, f in zip(missed, rnds, outputs):
+                shift = 0.1 + 0.5 * i / max(classifiers, 100)
+                scores = rnd.rand(size) * (1 - shift) + labels * shift
+                np.savetxt(f, scores, fmt='%.4f')
+    finally:
+        for f in outputs + [labels_output]:
+            if f is not None:
+                f.close()
+    for i in missed:
+        os.rename(files[i] + '.tmp', files[i])
+    if not has_answers:
+        os.rename(answers + '.tmp', answers)
+    return files + [answers]
+
+
+def run_case(files, options):
+    """
+    Calculate quality for files with profiler in current process.
+
+    Return dict with end to end and per stage measurements.
+    """
+    from clf_dp import ClassifiersDataProcessor, StageProfiler
+    profiler = StageProfiler()
+    started = wall_time()
+    cdp = ClassifiersDataProcessor(*files, profiler=profiler, **options)
+    cdp.calculate_quality()
+    wall = wall_time() - started
+    report = profiler.report()
+    rows = len(cdp.answer_array) if cdp.is_data_ok else 0
+    classifiers = len(files) - 1
+    return {'ok': cdp.is_data_ok, 'rows': rows, 'classifiers': classifiers,
+            'wall': wall, 'peak_rss': report['peak_rss'],
+            'rows_per_second': rows * classifiers / wall if wall else None,
+            'stages': report['totals']}
+
+
+def run_case_process(files, options):
+    """Run case in new interpreter, so peak memory belongs to case only."""
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--run-case',
+         json.dumps({'files': files, 'options': options})], cwd=HERE)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def git_commit():
+    """Return current git commit of repository or None."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=HERE, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').strip()
+
+
+def scale_benchmark(data_dir, rows_list, ratios, classifiers_list,
+                    options, baseline=True):
+    """
+    Measure quality calculation for every synthetic case and baseline.
+
+    Synthetic files for the biggest amount of classifiers are generated
+    once per rows amount and ratio, smaller cases use their first files.
+    Return list of results per case.
+    """
+    results = []
+    if baseline:
+        result = run_case_process(BASELINE_FILES, options)
+        result.update(case='baseline', positive_ratio=None)
+        results.append(result)
+    for rows in rows_list:
+        for ratio in ratios:
+            files = generate_case(data_dir, rows, ratio,
+                                  max(classifiers_list))
+            for classifiers in classifiers_list:
+                result = run_case_process(
+                    files[:classifiers] + files[-1:], options)
+                result.update(case=case_name(rows, ratio, classifiers),
+                              positive_ratio=ratio)
+                results.append(result)
+    return results
+
+
+def save_scale_results(results, filename, options):
+    """
+    Append scale results to JSON lines file, one line per case.
+
+    Every line contains commit, python and numpy versions and options,
+    so results of different commits can be kept in one file.
+    """
+    environment = {'commit': git_commit(), 'python': sys.version.split()[0],
+                   'numpy': np.__version__, 'options': options,
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(filename, 'a') as f:
+        for result in results:
+            line = dict(environment, **result)
+            f.write(json.dumps(line, sort_keys=True) + '\n')
+
+
+def compare_results(filename, old_commit, new_commit):
+    """
+    Compare scale results of two commits by case names.
+
+    Return list of (case, old wall, new wall, new / old wall ratio,
+    old peak RSS, new peak RSS) tuples, the latest result is taken
+    for every case, options and commit. Commit can be given by prefix.
+    """
+    latest = {}
+    with open(filename) as f:
+        for line in f:
+            result = json.loads(line)
+            case = "%s %s" % (result['case'],
+                              json.dumps(result['options'], sort_keys=True))
+            for commit in (old_commit, new_commit):
+                if (result.get('commit') or '').startswith(commit):
+                    latest[(commit, case)] = result
+    rows = []
+    for (commit, case), old in sorted(latest.items()):
+        new = latest.get((new_commit, case))
+        if commit != old_commit or new is None:
+            continue
+        rows.append((case, old['wall'], new['wall'],
+                     new['wall'] / old['wall'], old['peak_rss'],
+                     new['peak_rss']))
+    return rows
+
+
+def save_results(results, filename):
+    """Save benchmark results as JSON, '-' is for stdout."""
+    if filename == '-':
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Benchmark classifiers data processor.")
+    parser.add_argument('--startup', action='store_true',
+                        help="measure cold start time of module import "
+                             "and command line calls")
+    parser.add_argument('--repeat', type=int, default=10,
+                        help="amount of runs for every startup case "
+                             "(default 10)")
+    parser.add_argument('-o', '--output', metavar='JSON_FILE', default='-',
+                        help="save startup results in JSON_FILE (default "
+                             "'-' for stdout)")
+    parser.add_argument('--scale', metavar='RESULTS_FILE',
+                        help="measure quality calculation on synthetic and "
+                             "baseline data, append results to RESULTS_FILE "
+                             "as JSON lines")
+    parser.add_argument('--rows', default='1e5,1e6,1e7',
+                        help="comma separated amounts of rows for scale "
+                             "benchmark (default 1e5,1e6,1e7), 1e8 needs "
+                             "about 1 GB of disk per classifier")
+    parser.add_argument('--ratios', default='0.5,0.01',
+                        help="comma separated positive answers ratios "
+                             "(default 0.5,0.01)")
+    parser.add_argument('--classifiers', default='1,10',
+                        help="comma separated amounts of classifiers, "
+                             "up to 100 (default 1,10)")
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'bench'),
+                        help="directory for generated data files "
+                             "(default 'bench')")
+    parser.add_argument('--no-baseline', action='store_true',
+                        help="don't measure files from 'data' directory")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="amount of processes for classifiers data "
+                             "scoring (default 1)")
+    parser.add_argument('--compact', action='store_true',
+                        help="run cases in compact memory mode")
+    parser.add_argument('--use-cache', action='store_true',
+                        help="allow parsed data cache, cold CSV parsing is "
+                             "measured by default")
+    parser.add_argument('--compare', nargs=3,
+                        metavar=('RESULTS_FILE', 'OLD_COMMIT', 'NEW_COMMIT'),
+                        help="compare scale results of two commits")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_case:
+        case = json.loads(args.run_case)
+        print(json.dumps(run_case(case['files'], case['options'])))
+        sys.exit(0)
+    if args.repeat < 1:
+        parser.error("amount of runs must be positive")
+    if not (args.startup or args.scale or args.compare):
+        parser.error("choose benchmark to run")
+    if args.startup:
+        save_results({'python': sys.version.split()[0],
+                      'startup': startup_benchmark(args.repeat)},
+                     args.output)
+    if args.scale:
+        rows_list = [int(float(r)) for r in args.rows.split(',')]
+        ratios = [float(r) for r in args.ratios.split(',')]
+        classifiers_list = [int(c) for c in args.classifiers.split(',')]
+        if min(rows_list) < 1 or min(classifiers_list) < 1:
+            parser.error("amounts of rows and classifiers must be positive")
+        if not all(0 < r < 1 for r in ratios):
+            parser.error("positive answers ratios must be in (0, 1)")
+        options = {'workers': args.workers, 'compact': args.compact,
+                   'use_cache': args.use_cache}
+        results = scale_benchmark(args.data_dir, rows_list, ratios,
+                                  classifiers_list, options,
+                                  not args.no_baseline)
+        save_scale_results(results, args.scale, options)
+        for result in results:
+            print("%s: %.3f s, %.0f rows/s, peak RSS %d MB" % (
+                result['case'], result['wall'],
+                result['rows_per_second'] or 0,
+                result['peak_rss'] // (1024 * 1024)))
+    if args.compare:
+        for row in compare_results(*args.compare):
+            print("%s: %.3f s -> %.3f s (x%.2f), peak RSS %d MB -> %d MB" % (
+                row[:4] + (row[4] // (1024 * 1024), row[5] // (1024 * 1024))))
@@ -7,40 +7,306 @@ It allow to determine quality function
 and find classifier with best quality.
 """
 
+import io
 import os
+import sys
+import json
+import math
+import time
+import shutil
+import struct
+import hashlib
+import tempfile
+import collections
 import numpy as np
-from sklearn import metrics
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class DataLengthError(ValueError):
+    """Classifier and answers data have different length."""
+
+    pass
+
+
+RANKING_METRICS = ('roc_auc', 'prc_auc', 'average_precision')
+TOP_K_METRICS = ('precision', 'recall', 'lift')
+CHUNK_ROWS = 1024 * 1024
+
+
+class QuantizedScores(np.ndarray):
+    """Classifier scores stored as integer codes, score = code / scale."""
+
+    def __new__(cls, codes, scale):
+        """Wrap integer codes array."""
+        obj = np.asarray(codes).view(cls)
+        obj.scale = scale
+        return obj
+
+    def __array_finalize__(self, obj):
+        """Keep scale in views and slices."""
+        self.scale = getattr(obj, 'scale', 1)
+
+
+class NullStage:
+    """Stage context which records nothing."""
+
+    def __enter__(self):
+        """Enter stage."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Exit stage."""
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    """Stage context which measures time and memory for profiler."""
+
+    def __init__(self, profiler, name, info):
+        """Keep stage name and extra info, like file name."""
+        self.profiler = profiler
+        self.name = name
+        self.info = info
+
+    def __enter__(self):
+        """Remember time and memory at stage start."""
+        self.peak_rss = self.profiler.peak_rss()
+        self.cpu = self.profiler.cpu_time()
+        self.wall = self.profiler.wall_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Record stage measurements."""
+        wall = self.profiler.wall_time() - self.wall
+        cpu = self.profiler.cpu_time() - self.cpu
+        peak_rss = self.profiler.peak_rss()
+        record = dict(self.info, stage=self.name, wall=wall, cpu=cpu,
+                      peak_rss=peak_rss,
+                      peak_rss_growth=peak_rss - self.peak_rss,
+                      failed=exc_info[0] is not None)
+        self.profiler.record(record)
+        return False
+
+
+class StageProfiler:
+    """
+    Collect wall time, CPU time and peak memory of processing stages.
+
+    Peak memory is peak resident set size of the whole process in bytes,
+    so 'peak_rss_growth' shows how much stage raised it. Override
+    'record' method to send measurements to monitoring at once.
+    """
+
+    wall_time = staticmethod(getattr(time, 'perf_counter', time.time))
+
+    def __init__(self):
+        """Initialize empty records list."""
+        self.records = []
+        self.started = self.wall_time()
+
+    def stage(self, name, **info):
+        """Return context for stage measurement."""
+        return Stage(self, name, info)
+
+    def record(self, record):
+        """Keep stage measurements."""
+        self.records.append(record)
+
+    def cpu_time(self):
+        """Return CPU time of the process in seconds."""
+        times = os.times()
+        return times[0] + times[1]
+
+    def peak_rss(self):
+        """Return peak resident set size of the process in bytes."""
+        if resource is None:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def report(self):
+        """Return stages measurements and totals per stage."""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'],
+                                      {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            total['count'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+        return {'stages': list(self.records), 'totals': totals,
+                'wall': self.wall_time() - self.started,
+                'peak_rss': self.peak_rss()}
 
 
 class ClassifiersDataProcessor:
     """Process classifiers data."""
 
-    def __init__(self, *args):
-        """Initialize class instance."""
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize class instance.
+
+        Keyword arguments:
+        use_cache -- keep parsed CSV data in '.npy' sidecar files
+                     (default True)
+        cache_dir -- directory for sidecar files, by default they are
+                     stored next to the CSV files
+        workers -- amount of processes for classifiers data loading and
+                   scoring (default 1)
+        stream -- read data files by chunks and calculate scores with
+                  score histograms, so memory usage doesn't depend on
+                  data length (default False)
+        bins -- amount of histogram bins in stream mode (default 100000)
+        decimals -- amount of decimals in quantized classifiers data,
+                    in stream mode every distinct score gets own bin and
+                    scores are exact (default None)
+        score_range -- range of classifiers data values in stream mode
+                       (default (0.0, 1.0))
+        chunk_bytes -- size of data chunk in stream mode
+                       (default 4 MiB)
+        columnar -- take answers and all classifiers data from one file:
+                    CSV file with header, '.npy' file with named fields
+                    or 2D array, or '.npz' file (default False)
+        labels_column -- name of answers column in columnar mode,
+                         by default the last column is used
+        quality -- quality metric used for classifiers comparison:
+                   'roc_auc', 'prc_auc', 'average_precision',
+                   'precision@K', 'recall@K', 'lift@K' or 'auto' for
+                   PR AUC with classes disbalance and ROC AUC without it
+                   (default 'auto')
+        leaderboard -- path of JSON file with cached classifiers scores,
+                       only new or changed classifiers data files are
+                       scored (default None)
+        answers -- answers file, it can be given instead of the last
+                   file to load answers without classifiers files
+        compact -- keep answers as 'uint8' array only and classifiers
+                   data as 'uint16' codes if they have at most 4 decimals
+                   or as 'float32' otherwise (default False)
+        profiler -- StageProfiler instance to measure processing stages,
+                    stages aren't measured inside parallel workers
+                    (default None)
+        """
+        self.use_cache = kwargs.pop('use_cache', True)
+        self.cache_dir = kwargs.pop('cache_dir', None)
+        self.workers = kwargs.pop('workers', 1)
+        if self.workers < 1:
+            raise ValueError("Amount of workers must be positive")
+        self.stream = kwargs.pop('stream', False)
+        self.bins = kwargs.pop('bins', 100000)
+        self.decimals = kwargs.pop('decimals', None)
+        self.score_range = kwargs.pop('score_range', (0.0, 1.0))
+        if not self.score_range[0] < self.score_range[1]:
+            raise ValueError("Score range low bound must be less than high "
+                             "bound")
+        self.chunk_bytes = kwargs.pop('chunk_bytes', 4 * 1024 * 1024)
+        self.columnar = kwargs.pop('columnar', False)
+        self.labels_column = kwargs.pop('labels_column', None)
+        self.quality_name = kwargs.pop('quality', 'auto')
+        self.leaderboard = kwargs.pop('leaderboard', None)
+        self.leaderboard_hits = 0
+        self.compact = kwargs.pop('compact', False)
+        self.profiler = kwargs.pop('profiler', None)
+        answers = kwargs.pop('answers', None)
+        if answers is not None:
+            args = args + (answers,)
+        if self.quality_name not in RANKING_METRICS + ('auto',):
+            self.parse_top_k(self.quality_name)
+            if self.stream:
+                raise ValueError("Top k metrics aren't supported in stream "
+                                 "mode")
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s" %
+                            ', '.join(sorted(kwargs)))
         self.files = []
         self.quality = []
+        self.scores = []
         self.answer_array = None
+        self.labels = None
+        self.labels_source = None
+        self.positive_count = 0
+        self.negative_count = 0
         self.quality_func = None
+        self.quality_metric = None
+        self.container = None
+        self.columns = {}
         self.is_data_ok = True
-        if len(args) < 2:
+        if self.columnar:
+            if len(args) != 1:
+                self.is_data_ok = False
+                print("Exactly one data file is needed in columnar mode")
+            elif self.stream:
+                self.is_data_ok = False
+                print("Columnar data can't be read in stream mode")
+            else:
+                with self.stage('check_file', file=args[0]):
+                    self.container = self.check_file(args[0])
+                if self.is_data_ok:
+                    self.files = self.container_columns()
+        elif len(args) < (1 if answers is not None else 2):
             self.is_data_ok = False
             print("Not enough files")
         else:
-            for f in args:
-                self.files.append(self.check_file(f))
+            for f in self.expand_dirs(args):
+                with self.stage('check_file', file=f):
+                    self.files.append(self.check_file(f))
 
-        if self.is_data_ok:
-            self.answer_array = np.genfromtxt(self.files[-1], delimiter=',')
-            if not self.parse_answers(self.answer_array):
+        if self.is_data_ok and self.stream:
+            if not self.count_answers_stream(self.files[-1]):
                 self.is_data_ok = False
                 print("'%s' file contains some values which are not in {0, 1}. \
 Are you sure that it is a file with answers?" % self.files[-1])
+        elif self.is_data_ok:
+            self.answer_array = self.load_data(self.files[-1])
+            with self.stage('parse_answers', file=self.files[-1]):
+                is_answers_ok = self.parse_answers(self.answer_array)
+            if not is_answers_ok:
+                self.is_data_ok = False
+                print("'%s' file contains some values which are not in {0, 1}. \
+Are you sure that it is a file with answers?" % self.files[-1])
+            else:
+                self.index_answers()
+                if self.compact:
+                    self.answer_array = self.labels_source = self.labels
+
+    def stage(self, name, **info):
+        """Return profiler stage context, it does nothing without profiler."""
+        if self.profiler is None:
+            return NULL_STAGE
+        return self.profiler.stage(name, **info)
+
+    def expand_dirs(self, args):
+        """
+        Replace classifiers data directories by CSV files in them.
+
+        The last argument is answers file and it isn't expanded.
+        """
+        files = []
+        answers = os.path.abspath(args[-1]) if args else None
+        for f in args[:-1]:
+            if os.path.isdir(f):
+                files.extend(
+                    os.path.join(f, name) for name in sorted(os.listdir(f))
+                    if self.is_csv(name) and not name.startswith('.') and
+                    os.path.abspath(os.path.join(f, name)) != answers)
+            else:
+                files.append(f)
+        return files + list(args[-1:])
 
     def is_csv(self, filename):
         """Check that file has 'csv' extension."""
         f_name = os.path.basename(filename)
         return f_name.split('.')[-1].lower() == 'csv'
 
+    def is_numpy(self, filename):
+        """Check that file has 'npy' or 'npz' extension."""
+        f_name = os.path.basename(filename)
+        return f_name.split('.')[-1].lower() in ('npy', 'npz')
+
     def check_file(self, filename):
         """Simple check that path exists and it is file."""
         f = os.path.abspath(filename)
@@ -53,18 +319,339 @@ Please check input parameters" % filename)
             self.is_data_ok = False
             print("'%s' is not a file" % filename)
             return None
-        if not self.is_csv(f):
+        if not self.is_csv(f) and not (self.columnar and self.is_numpy(f)):
             self.is_data_ok = False
             print("'%s' is not a CSV file" % filename)
             return None
         return f
 
+    def sidecar_path(self, filename):
+        """
+        Return path of binary sidecar file for specified CSV file.
+
+        Sidecar name contains a hash of CSV file path and a key built
+        from its size and modification time, so any change of CSV file
+        invalidates it and files with the same name in different
+        directories don't share sidecars.
+        """
+        f = os.path.abspath(filename)
+        st = os.stat(f)
+        path_key = hashlib.md5(f.encode('utf-8')).hexdigest()
+        key = hashlib.md5(("%d|%r" % (
+            st.st_size, st.st_mtime)).encode('utf-8')).hexdigest()
+        cache_dir = self.cache_dir or os.path.dirname(f)
+        return os.path.join(cache_dir, ".%s.%s.%s.npy" % (
+            os.path.basename(f), path_key[:8], key[:16]))
+
+    def parse_csv(self, filename):
+        """
+        Parse single column numeric CSV file.
+
+        Numbers are parsed by numpy C parser. If file has any data which
+        can't be parsed this way (empty lines, several columns, missed
+        values) slow 'np.genfromtxt' is used.
+        """
+        with open(filename, 'rb') as f:
+            return self.parse_csv_data(f.read())
+
+    def parse_csv_data(self, data):
+        """Parse bytes with single column numeric CSV data."""
+        lines = data.count(b'\n')
+        if data and not data.endswith(b'\n'):
+            lines += 1
+        try:
+            array = np.fromstring(data, dtype=np.float64, sep='\n')
+        except ValueError:
+            array = None
+        if array is None or len(array) != lines:
+            array = np.atleast_1d(np.genfromtxt(io.BytesIO(data),
+                                                delimiter=','))
+        return array
+
+    def iter_csv_chunks(self, filename):
+        """Parse single column CSV file by chunks of whole lines."""
+        with open(filename, 'rb') as f:
+            tail = b''
+            while True:
+                block = f.read(self.chunk_bytes)
+                if not block:
+                    break
+                block = tail + block
+                end = block.rfind(b'\n') + 1
+                tail = block[end:]
+                if end:
+                    yield self.parse_csv_data(block[:end])
+            if tail.strip():
+                yield self.parse_csv_data(tail)
+
+    def iter_aligned_chunks(self, clf_file, answers_file):
+        """
+        Read classifier and answers files by aligned chunks.
+
+        Yield pairs of arrays with the same length.
+        Raise DataLengthError if files have different amount of values.
+        """
+        clf_chunks = self.iter_csv_chunks(clf_file)
+        answers_chunks = self.iter_csv_chunks(answers_file)
+        clf_rest = answers_rest = np.empty(0)
+        while True:
+            if not len(clf_rest):
+                clf_rest = next(clf_chunks, None)
+            if not len(answers_rest):
+                answers_rest = next(answers_chunks, None)
+            if clf_rest is None or answers_rest is None:
+                if clf_rest is not None or answers_rest is not None:
+                    raise DataLengthError("'%s' and '%s' have different "
+                                          "data length" % (clf_file,
+                                                           answers_file))
+                return
+            n = min(len(clf_rest), len(answers_rest))
+            if n:
+                yield clf_rest[:n], answers_rest[:n]
+            clf_rest, answers_rest = clf_rest[n:], answers_rest[n:]
+
+    def parse_wide_csv(self, filename):
+        """
+        Parse numeric CSV file with header into 2D array.
+
+        Numbers are parsed by numpy C parser, 'np.genfromtxt' is used
+        only for irregular data.
+        """
+        with open(filename, 'rb') as f:
+            width = len(f.readline().split(b','))
+            data = f.read()
+        lines = data.count(b'\n')
+        if data and not data.endswith(b'\n'):
+            lines += 1
+        try:
+            array = np.fromstring(data.replace(b'\n', b','),
+                                  dtype=np.float64, sep=',')
+        except ValueError:
+            array = None
+        if array is None or len(array) != lines * width:
+            array = np.genfromtxt(io.BytesIO(data), delimiter=',')
+        return array.reshape(-1, width)
+
+    def load_npz(self, filename):
+        """
+        Load all arrays from '.npz' file.
+
+        Arrays stored without compression are memory-mapped in place,
+        compressed arrays are read into memory.
+        Return ordered dict of arrays by names.
+        """
+        import zipfile
+        arrays = collections.OrderedDict()
+        archive = zipfile.ZipFile(filename)
+        with open(filename, 'rb') as f:
+            for info in archive.infolist():
+                name = info.filename
+                if name.endswith('.npy'):
+                    name = name[:-len('.npy')]
+                array = None
+                if info.compress_type == zipfile.ZIP_STORED:
+                    f.seek(info.header_offset)
+                    header = f.read(30)
+                    if header[:4] == b'PK\x03\x04':
+                        name_len, extra_len = struct.unpack('<HH',
+                                                            header[26:30])
+                        f.seek(info.header_offset + 30 + name_len + extra_len)
+                        array = self.map_npy(filename, f)
+                if array is None:
+                    array = np.lib.format.read_array(archive.open(info))
+                arrays[name] = array
+        archive.close()
+        return arrays
+
+    def map_npy(self, filename, f):
+        """
+        Memory-map '.npy' data which starts at current position of 'f'.
+
+        Return None if data can't be mapped.
+        """
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return None
+        if dtype.hasobject or not np.prod(shape):
+            return None
+        return np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                         order='F' if fortran else 'C', offset=f.tell())
+
+    def open_container(self):
+        """
+        Open columnar data file and map its columns by names.
+
+        Columns are views of memory-mapped data, so they are not copied.
+        Return list of column names in file order.
+        """
+        extension = self.container.split('.')[-1].lower()
+        if extension == 'npz':
+            columns = self.load_npz(self.container)
+            names = list(columns)
+        else:
+            if extension == 'npy':
+                array = np.load(self.container, mmap_mode='r')
+            else:
+                array = self.load_csv(self.container, self.parse_wide_csv)
+                with open(self.container, 'rb') as f:
+                    header = f.readline().decode('utf-8')
+            if array.dtype.names:
+                names = list(array.dtype.names)
+                columns = dict((n, array[n]) for n in names)
+            elif array.ndim == 2:
+                if extension == 'npy':
+                    names = [str(i) for i in range(array.shape[1])]
+                else:
+                    names = [n.strip().strip('"') for n in header.split(',')]
+                columns = dict((n, array[:, i]) for i, n in enumerate(names))
+            else:
+                names = []
+                columns = {}
+        self.columns = dict(("%s:%s" % (self.container, n), a)
+                            for n, a in columns.items())
+        return names
+
+    def container_columns(self):
+        """
+        Return columnar data names with answers column in the end.
+
+        Names have 'FILE:COLUMN' format.
+        """
+        names = self.open_container()
+        labels = self.labels_column
+        if labels is None and names:
+            labels = names[-1]
+        if labels not in names or len(names) < 2:
+            self.is_data_ok = False
+            print("'%s' file must contain answers column%s and at least one "
+                  "classifier column" % (self.container, (
+                      " '%s'" % labels if labels is not None else "")))
+            return []
+        names.remove(labels)
+        return ["%s:%s" % (self.container, n) for n in names + [labels]]
+
+    def load_data(self, name):
+        """Return classifier or answers data by file or column name."""
+        with self.stage('load', file=name):
+            if self.container is None:
+                return self.load_csv(name)
+            if not self.columns:
+                self.open_container()
+            return self.columns[name]
+
+    def load_scores(self, name):
+        """Return classifier data, in compact form if it is enabled."""
+        clf_array = self.load_data(name)
+        if self.compact:
+            clf_array = self.compact_scores(clf_array)
+        return clf_array
+
+    def compact_scores(self, clf_array):
+        """
+        Convert classifier data to compact form.
+
+        Data with at most 4 decimals in [0, 65535 / 10 ** decimals] range
+        are stored as 'uint16' codes, other data as 'float32'.
+        Conversion goes by chunks, so float64 temporary arrays are small.
+        """
+        if isinstance(clf_array, QuantizedScores):
+            return clf_array
+        rows = len(clf_array)
+        codes = np.empty(rows, dtype=np.uint16)
+        for decimals in range(4, -1, -1):
+            scale = 10 ** decimals
+            for start in range(0, rows, CHUNK_ROWS):
+                part = np.asarray(clf_array[start:start + CHUNK_ROWS]) * scale
+                rounded = np.rint(part)
+                if not ((np.abs(part - rounded) < 1e-6).all() and
+                        (rounded >= 0).all() and (rounded <= 65535).all()):
+                    break
+                codes[start:start + CHUNK_ROWS] = rounded
+            else:
+                return QuantizedScores(codes, scale)
+        return np.asarray(clf_array, dtype=np.float32)
+
+    def write_sidecar(self, sidecar, array):
+        """Save array to sidecar file, drop outdated sidecars of the file."""
+        prefix = os.path.basename(sidecar).rsplit('.', 2)[0] + '.'
+        cache_dir = os.path.dirname(sidecar)
+        tmp = None
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            for f in os.listdir(cache_dir):
+                key = f[len(prefix):-len('.npy')]
+                if (f.startswith(prefix) and f.endswith('.npy') and
+                        len(key) == 16 and '.' not in key and
+                        f != os.path.basename(sidecar)):
+                    try:
+                        os.remove(os.path.join(cache_dir, f))
+                    except OSError:
+                        pass
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.rename(tmp, sidecar)
+        except (IOError, OSError):
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def load_csv(self, filename, parser=None):
+        """
+        Load data from single column CSV file.
+
+        If caching is on, parsed data are saved into binary sidecar file
+        and next loads of unchanged CSV file return memory-mapped
+        read-only array without parsing and copying.
+        Other CSV formats can be loaded with custom 'parser'.
+        """
+        parser = parser or self.parse_csv
+        if not self.use_cache:
+            return parser(filename)
+        sidecar = self.sidecar_path(filename)
+        if os.path.exists(sidecar):
+            try:
+                return np.load(sidecar, mmap_mode='r')
+            except (IOError, OSError, ValueError):
+                pass
+        array = parser(filename)
+        if self.write_sidecar(sidecar, array):
+            try:
+                return np.load(sidecar, mmap_mode='r')
+            except (IOError, OSError, ValueError):
+                pass
+        return array
+
     def parse_answers(self, answers_array):
         """Check that array contains only 0 and 1."""
-        for x in answers_array:
-            if x not in (0, 1):
-                return False
-        return True
+        answers_array = np.asarray(answers_array)
+        return bool(np.all((answers_array == 0) | (answers_array == 1)))
+
+    def index_answers(self):
+        """
+        Build compact labels index for answers.
+
+        Answers are stored as 'uint8' array with amount of positive and
+        negative answers. Index is built again only if 'answer_array'
+        was replaced, so all classifiers share one index.
+        """
+        if self.answer_array is None:
+            return
+        if self.labels is not None and self.labels_source is self.answer_array:
+            return
+        self.labels = np.asarray(self.answer_array).astype(np.uint8,
+                                                           copy=False)
+        self.labels_source = self.answer_array
+        self.positive_count = int(np.count_nonzero(self.labels))
+        self.negative_count = len(self.labels) - self.positive_count
+        self.quality_func = None
+        self.quality_metric = None
 
     def is_classes_disbalance(self):
         """
@@ -73,43 +660,749 @@ Please check input parameters" % filename)
         Return True if amount of data for one class < 5%
         from all data amount.
         """
-        data_amount = float(len(self.answer_array))
-        f_class = sum(self.answer_array)
-        z_class = data_amount - f_class
+        self.index_answers()
+        data_amount = float(self.positive_count + self.negative_count)
+        f_class = self.positive_count
+        z_class = self.negative_count
         return min(f_class / data_amount, z_class / data_amount) < 0.05
 
+    def trapezoid(self, x, y):
+        """Calculate area under curve with trapezoidal rule."""
+        return (np.diff(x, axis=-1) *
+                (y[..., 1:] + y[..., :-1]) / 2.0).sum(axis=-1)
+
+    def rank_curve(self, clf_array):
+        """
+        Build cumulative true and false positives for classifier data.
+
+        Scores are sorted once in descending order. Equal scores make one
+        threshold, so returned arrays contain amount of true and false
+        positives for each distinct score.
+        """
+        _, tps, fps = self.threshold_curve(clf_array)
+        return tps, fps
+
+    def threshold_curve(self, clf_array):
+        """
+        Build cumulative true and false positives with threshold values.
+
+        Return (thresholds, tps, fps), thresholds are distinct scores
+        in descending order.
+        """
+        self.index_answers()
+        if isinstance(clf_array, QuantizedScores):
+            return self.counting_curve(clf_array)
+        order = np.argsort(clf_array, kind='mergesort')[::-1]
+        scores = np.asarray(clf_array)[order]
+        answers = self.labels[order]
+        threshold_idxs = np.r_[np.where(np.diff(scores))[0], len(scores) - 1]
+        starts = np.r_[0, threshold_idxs[:-1] + 1]
+        tps = np.cumsum(np.add.reduceat(answers, starts, dtype=np.int64))
+        tps = tps.astype(np.float64)
+        fps = 1 + threshold_idxs - tps
+        return scores[threshold_idxs], tps, fps
+
+    def counting_curve(self, clf_array):
+        """
+        Build threshold curve for quantized scores without sorting.
+
+        Amounts of answers for every code are counted by chunks, so no
+        arrays with data length are created besides answers mask.
+        """
+        size = int(clf_array.max()) + 1
+        total = np.zeros(size, dtype=np.int64)
+        positive = np.zeros(size, dtype=np.int64)
+        for start in range(0, len(clf_array), CHUNK_ROWS):
+            codes = np.asarray(clf_array[start:start + CHUNK_ROWS])
+            is_positive = self.labels[start:start + CHUNK_ROWS] != 0
+            total += np.bincount(codes, minlength=size)
+            positive += np.bincount(codes[is_positive], minlength=size)
+        present = np.flatnonzero(total)[::-1]
+        tps = np.cumsum(positive[present]).astype(np.float64)
+        fps = np.cumsum(total[present] - positive[present]).astype(np.float64)
+        return present / float(clf_array.scale), tps, fps
+
+    def rank_scores(self, clf_array):
+        """
+        Calculate ROC AUC, PR AUC and average precision together.
+
+        All values are taken from one sort of classifier data.
+        Return dict with 'roc_auc', 'prc_auc' and 'average_precision' keys.
+        Values which can't be calculated for one class answers are NaN.
+        """
+        if not len(clf_array):
+            return self.curve_scores(np.empty(0), np.empty(0))
+        tps, fps = self.rank_curve(clf_array)
+        return self.curve_scores(tps, fps)
+
+    def curve_scores(self, tps, fps, metrics=RANKING_METRICS):
+        """
+        Calculate ROC AUC, PR AUC and average precision from curve.
+
+        'tps' and 'fps' are cumulative amounts of true and false
+        positives for thresholds in descending order. 2D arrays are
+        handled as several curves, one per row.
+        Thresholds without any data (zero weights) are allowed.
+        Only scores listed in 'metrics' are calculated.
+        """
+        nan = float('nan')
+        result = dict((metric, nan) for metric in metrics)
+        if not tps.shape[-1]:
+            return result
+        zeros = np.zeros(tps.shape[:-1] + (1,))
+        total_tps = tps[..., -1:]
+        total_fps = fps[..., -1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if 'roc_auc' in metrics:
+                result['roc_auc'] = self.trapezoid(
+                        np.concatenate((zeros, fps / total_fps), axis=-1),
+                        np.concatenate((zeros, tps / total_tps), axis=-1))
+            if 'prc_auc' not in metrics and (
+                    'average_precision' not in metrics):
+                return result
+            recall = np.concatenate((zeros, tps / total_tps), axis=-1)
+            precision = np.where(tps + fps > 0, tps / (tps + fps), 1.0)
+            precision = np.concatenate((zeros + 1, precision), axis=-1)
+            if 'prc_auc' in metrics:
+                result['prc_auc'] = self.trapezoid(recall, precision)
+            if 'average_precision' in metrics:
+                result['average_precision'] = (
+                        np.diff(recall, axis=-1) *
+                        precision[..., 1:]).sum(axis=-1)
+        return result
+
+    def metric_suite(self, clf_array, thresholds=(0.5,), calibration_bins=10):
+        """
+        Calculate quality metrics suite for classifier data.
+
+        All metrics are taken from one sort of classifier data: ranking
+        scores, log loss, Brier score, best F1 threshold, precision and
+        recall for 'thresholds' (score >= threshold is positive answer)
+        and calibration for 'calibration_bins' equal bins of [0, 1].
+        Return dict with plain Python values, None is used for values
+        which can't be calculated.
+        """
+        if not len(clf_array):
+            return None
+        values, tps, fps = self.threshold_curve(clf_array)
+        pos = np.diff(np.r_[0, tps])
+        neg = np.diff(np.r_[0, fps])
+        total = tps[-1] + fps[-1]
+        result = dict((k, None if np.isnan(v) else float(v)) for k, v in
+                      self.curve_scores(tps, fps).items())
+        eps = 1e-15
+        clipped = np.clip(values, eps, 1 - eps)
+        result['log_loss'] = float(-(pos * np.log(clipped) +
+                                     neg * np.log(1 - clipped)).sum() / total)
+        result['brier_score'] = float((pos * (1 - values) ** 2 +
+                                       neg * values ** 2).sum() / total)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = tps / (tps + fps)
+            recall = tps / tps[-1]
+            f1 = 2 * tps / (tps + fps + tps[-1])
+        best = int(np.argmax(f1))
+        result['best_f1'] = {'threshold': float(values[best]),
+                             'f1': float(f1[best]),
+                             'precision': float(precision[best]),
+                             'recall': float(recall[best])}
+        result['thresholds'] = []
+        for threshold in thresholds:
+            k = len(values) - np.searchsorted(values[::-1], threshold)
+            if k:
+                point = {'precision': float(precision[k - 1]),
+                         'recall': float(recall[k - 1])}
+            else:
+                point = {'precision': None, 'recall': 0.0}
+            point['threshold'] = threshold
+            result['thresholds'].append(point)
+        bins = np.clip((values * calibration_bins).astype(np.intp), 0,
+                       calibration_bins - 1)
+        counts = np.bincount(bins, pos + neg, calibration_bins)
+        positives = np.bincount(bins, pos, calibration_bins)
+        predicted = np.bincount(bins, (pos + neg) * values, calibration_bins)
+        result['calibration'] = []
+        for i in range(calibration_bins):
+            result['calibration'].append({
+                'low': float(i) / calibration_bins,
+                'high': float(i + 1) / calibration_bins,
+                'count': int(counts[i]),
+                'mean_predicted': float(predicted[i] / counts[i])
+                if counts[i] else None,
+                'fraction_positive': float(positives[i] / counts[i])
+                if counts[i] else None})
+        return result
+
+    def metric_report(self, thresholds=(0.5,), calibration_bins=10):
+        """
+        Calculate metrics suite for all classifiers.
+
+        Return dict ready for JSON serialization or None for wrong data.
+        Metrics of classifiers with wrong data length are None.
+        """
+        if self.stream:
+            print("Metrics suite isn't supported in stream mode")
+            return None
+        if not self.is_data_ok:
+            return None
+        self.set_quality_func()
+        report = {'answers': self.files[-1],
+                  'positive': self.positive_count,
+                  'negative': self.negative_count,
+                  'quality_metric': self.quality_metric,
+                  'classifiers': []}
+        for f in self.files[:-1]:
+            clf_array = self.load_scores(f)
+            metrics_suite = None
+            if len(clf_array) == len(self.answer_array):
+                metrics_suite = self.metric_suite(clf_array, thresholds,
+                                                  calibration_bins)
+            report['classifiers'].append({'file': f,
+                                          'metrics': metrics_suite})
+        return report
+
+    def load_groups(self, filename):
+        """
+        Load segment ids aligned with answers.
+
+        Ids can be numbers or strings, ids file isn't cached. Return
+        (segment names, segment index of every row) or None for wrong
+        file.
+        """
+        f = self.check_file(filename)
+        if f is None:
+            return None
+        with open(f, 'rb') as groups_file:
+            data = groups_file.read()
+        groups = self.parse_csv_data(data)
+        if np.isnan(groups).any():
+            groups = np.array([line.strip().decode('utf-8')
+                               for line in data.splitlines() if line.strip()])
+        names, codes = np.unique(groups, return_inverse=True)
+        return names.tolist(), codes.reshape(-1)
+
+    def segment_scores(self, clf_array, codes, segments_amount):
+        """
+        Calculate ranking scores for every segment of classifier data.
+
+        Data are sorted once by (segment, score), ties are handled per
+        segment as in 'rank_scores'. Return dict of arrays with scores
+        and amounts of positive and negative answers per segment.
+        """
+        self.index_answers()
+        scores = np.asarray(clf_array)
+        if scores.dtype.kind == 'u':
+            order = np.lexsort((~scores, codes))
+        else:
+            order = np.lexsort((-scores, codes))
+        scores = scores[order]
+        codes = codes[order]
+        answers = self.labels[order]
+        is_end = np.ones(len(scores), dtype=bool)
+        is_end[:-1] = (codes[1:] != codes[:-1]) | (scores[1:] != scores[:-1])
+        ends = np.flatnonzero(is_end)
+        starts = np.r_[0, ends[:-1] + 1]
+        pos = np.add.reduceat(answers, starts, dtype=np.float64)
+        neg = ends - starts + 1 - pos
+        segment = codes[starts]
+        total_pos = np.bincount(segment, pos, segments_amount)
+        total_neg = np.bincount(segment, neg, segments_amount)
+        is_first = np.r_[True, segment[1:] != segment[:-1]]
+        segment_start = np.maximum.accumulate(
+                np.where(is_first, np.arange(len(segment)), 0))
+        cum_pos = np.cumsum(pos)
+        cum_neg = np.cumsum(neg)
+        tps = cum_pos - (cum_pos - pos)[segment_start]
+        fps = cum_neg - (cum_neg - neg)[segment_start]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            roc = np.bincount(segment, neg * (tps - pos / 2.0),
+                              segments_amount) / (total_pos * total_neg)
+            precision = tps / (tps + fps)
+            previous = np.where(is_first, 1.0, np.r_[1.0, precision[:-1]])
+            recall_step = pos / total_pos[segment]
+            prc = np.bincount(segment, recall_step * (precision + previous) /
+                              2.0, segments_amount)
+            ap = np.bincount(segment, recall_step * precision,
+                             segments_amount)
+        prc[total_pos == 0] = np.nan
+        ap[total_pos == 0] = np.nan
+        return {'roc_auc': roc, 'prc_auc': prc, 'average_precision': ap,
+                'positive': total_pos.astype(np.int64),
+                'negative': total_neg.astype(np.int64)}
+
+    def segment_report(self, groups_file):
+        """
+        Calculate ranking scores per segment for all classifiers.
+
+        'groups_file' contains segment id for every answer.
+        Return dict ready for JSON serialization or None for wrong data.
+        """
+        if self.stream:
+            print("Segments scores aren't supported in stream mode")
+            return None
+        if not self.is_data_ok:
+            return None
+        groups = self.load_groups(groups_file)
+        if groups is None:
+            return None
+        names, codes = groups
+        if len(codes) != len(self.answer_array):
+            print("Data length in '%s' and answers file don't match" %
+                  groups_file)
+            return None
+        report = {'segments': names, 'classifiers': []}
+        for f in self.files[:-1]:
+            clf_array = self.load_scores(f)
+            segments = None
+            if len(clf_array) == len(self.answer_array):
+                segments = {}
+                for key, values in self.segment_scores(
+                        clf_array, codes, len(names)).items():
+                    segments[key] = [None if np.isnan(v) else v
+                                     for v in values.tolist()]
+            report['classifiers'].append({'file': f, 'segments': segments})
+        return report
+
+    def count_answers_stream(self, filename):
+        """
+        Check answers file by chunks and count classes.
+
+        Return False if file contains values which are not in {0, 1}.
+        """
+        positive = negative = 0
+        for chunk in self.iter_csv_chunks(filename):
+            if not self.parse_answers(chunk):
+                return False
+            chunk_positive = int(np.count_nonzero(chunk))
+            positive += chunk_positive
+            negative += len(chunk) - chunk_positive
+        self.positive_count = positive
+        self.negative_count = negative
+        self.quality_func = None
+        self.quality_metric = None
+        return True
+
+    def score_bins(self, clf_array):
+        """
+        Return histogram bins indexes for classifier data.
+
+        With 'decimals' every quantized score gets own bin, ValueError is
+        raised for data which are not quantized or out of 'score_range'.
+        Otherwise 'bins' bins of equal width are used and values out of
+        'score_range' are counted in edge bins.
+        """
+        low, high = self.score_range
+        if np.isnan(clf_array).any():
+            raise ValueError("Classifier data contain NaN values")
+        if self.decimals is None:
+            scaled = (clf_array - low) * (self.bins / float(high - low))
+            return np.clip(scaled, 0, self.bins - 1).astype(np.intp)
+        scaled = (clf_array - low) * 10 ** self.decimals
+        idx = np.rint(scaled)
+        if (np.abs(scaled - idx) > 1e-3).any():
+            raise ValueError("Classifier data have more than %s decimals" %
+                             self.decimals)
+        if (idx < 0).any() or (idx >= self.histogram_size()).any():
+            raise ValueError("Classifier data are out of range %s" %
+                             (self.score_range,))
+        return idx.astype(np.intp)
+
+    def histogram_size(self):
+        """Return amount of histogram bins in stream mode."""
+        if self.decimals is None:
+            return self.bins
+        low, high = self.score_range
+        return int(round((high - low) * 10 ** self.decimals)) + 1
+
+    def score_histograms(self, clf_file, answers_file):
+        """
+        Build histograms of scores for positive and negative answers.
+
+        Files are read by aligned chunks, so memory usage is constant.
+        """
+        size = self.histogram_size()
+        positive = np.zeros(size, dtype=np.int64)
+        negative = np.zeros(size, dtype=np.int64)
+        for clf_chunk, answers_chunk in self.iter_aligned_chunks(
+                clf_file, answers_file):
+            if not self.parse_answers(answers_chunk):
+                raise ValueError("'%s' file contains some values which are "
+                                 "not in {0, 1}" % answers_file)
+            idx = self.score_bins(clf_chunk)
+            is_positive = answers_chunk == 1
+            positive += np.bincount(idx[is_positive], minlength=size)
+            negative += np.bincount(idx[~is_positive], minlength=size)
+        return positive, negative
+
+    def histogram_scores(self, positive, negative):
+        """
+        Calculate ranking scores from scores histograms.
+
+        Scores in one bin are handled as equal scores. Besides scores
+        result contains 'roc_auc_error' and 'prc_auc_error' keys with
+        upper bounds of absolute error caused by this:
+          - ROC AUC error <= sum(pos_i * neg_i) / (2 * P * N), where
+            pos_i, neg_i are amounts of answers in bin i and P, N are
+            total amounts of positive and negative answers;
+          - PR AUC and average precision error <= sum(pos_i / P *
+            (hi_i - lo_i)), where hi_i, lo_i are the highest and the
+            lowest precision reachable inside bin i.
+        With 'decimals' bins hold equal scores only, so bounds are 0.
+        """
+        keep = (positive + negative) > 0
+        pos = positive[keep][::-1].astype(np.float64)
+        neg = negative[keep][::-1].astype(np.float64)
+        tps = np.cumsum(pos)
+        fps = np.cumsum(neg)
+        result = self.curve_scores(tps, fps)
+        nan = float('nan')
+        result['roc_auc_error'] = result['prc_auc_error'] = nan
+        if not len(tps):
+            return result
+        if self.decimals is not None:
+            result['roc_auc_error'] = result['prc_auc_error'] = 0.0
+            return result
+        if tps[-1] and fps[-1]:
+            result['roc_auc_error'] = (pos * neg).sum() / (
+                2.0 * tps[-1] * fps[-1])
+        if tps[-1]:
+            tps_before = tps - pos
+            fps_before = fps - neg
+            with np.errstate(divide='ignore', invalid='ignore'):
+                high = np.where(tps_before == 0, 1.0, tps / (tps + fps_before))
+                low = np.where(tps_before + fps == 0, 1.0,
+                               tps_before / (tps_before + fps))
+            result['prc_auc_error'] = (pos / tps[-1] * (high - low)).sum()
+        return result
+
+    def stream_scores(self, clf_file, answers_file=None):
+        """
+        Calculate ranking scores for classifier data file by chunks.
+
+        Memory usage depends on histogram size only. Return None if
+        classifier and answers data length don't match.
+        """
+        if answers_file is None:
+            answers_file = self.files[-1]
+        try:
+            positive, negative = self.score_histograms(clf_file, answers_file)
+        except DataLengthError:
+            return None
+        return self.histogram_scores(positive, negative)
+
     def prc_auc_score(self, clf_array):
         """Calculate area under curve for precision-recall curve."""
-        precision, recall, _ = metrics.precision_recall_curve(
-                self.answer_array,
-                clf_array)
-        return metrics.auc(recall, precision)
+        return self.rank_scores(clf_array)['prc_auc']
 
     def roc_auc_score(self, clf_array):
         """Calculate area under ROC curve."""
-        return metrics.roc_auc_score(self.answer_array, clf_array)
+        return self.rank_scores(clf_array)['roc_auc']
+
+    def average_precision_score(self, clf_array):
+        """Calculate average precision."""
+        return self.rank_scores(clf_array)['average_precision']
+
+    def parse_top_k(self, name):
+        """
+        Split top k metric name like 'precision@100' to metric and k.
+
+        Raise ValueError for unknown metric name.
+        """
+        metric, _, k = name.partition('@')
+        if metric not in TOP_K_METRICS or not k.isdigit() or not int(k):
+            raise ValueError("Unknown quality metric '%s'" % name)
+        return metric, int(k)
+
+    def top_k_scores(self, clf_array, ks):
+        """
+        Calculate precision, recall and lift for k highest scores.
+
+        Scores are partially sorted with one 'argpartition' call for all
+        k values, so complexity is linear. Rows with score equal to k-th
+        highest score are counted proportionally, k greater than amount
+        of rows is limited by it.
+        Return dict with 'precision@K', 'recall@K' and 'lift@K' keys for
+        requested k values, raise ValueError for k less than 1.
+        """
+        if any(k < 1 for k in ks):
+            raise ValueError("k values must be positive")
+        self.index_answers()
+        scores = np.asarray(clf_array)
+        rows = len(scores)
+        result = {}
+        if not rows:
+            return result
+        kth = sorted(set(rows - min(k, rows) for k in ks))
+        order = np.argpartition(scores, kth)
+        rate = self.positive_count / float(rows)
+        for k in ks:
+            top = min(k, rows)
+            value = scores[order[rows - top]]
+            above = scores > value
+            tied = scores == value
+            positive = (np.count_nonzero(self.labels[above]) +
+                        (top - np.count_nonzero(above)) *
+                        np.count_nonzero(self.labels[tied]) /
+                        float(np.count_nonzero(tied)))
+            precision = positive / float(top)
+            result['precision@%d' % k] = precision
+            result['recall@%d' % k] = (positive / float(self.positive_count)
+                                       if self.positive_count
+                                       else float('nan'))
+            result['lift@%d' % k] = precision / rate if rate else float('nan')
+        return result
+
+    def top_k_score(self, clf_array):
+        """Calculate top k metric selected as quality metric."""
+        metric, k = self.parse_top_k(self.quality_metric)
+        if not len(clf_array):
+            return float('nan')
+        return self.top_k_scores(clf_array, [k])['%s@%d' % (metric, k)]
 
     def set_quality_func(self):
-        """Determine classifiers quality functions."""
-        if self.is_classes_disbalance():
+        """
+        Determine classifiers quality functions.
+
+        Selected function is kept until answers are changed.
+        """
+        self.index_answers()
+        if self.quality_func is not None:
+            return
+        with self.stage('set_quality_func'):
+            self.choose_quality_func()
+
+    def choose_quality_func(self):
+        """Choose quality function by quality name and classes balance."""
+        if self.quality_name == 'roc_auc':
+            self.quality_func = self.roc_auc_score
+            self.quality_metric = 'roc_auc'
+        elif self.quality_name == 'prc_auc':
+            self.quality_func = self.prc_auc_score
+            self.quality_metric = 'prc_auc'
+        elif self.quality_name == 'average_precision':
+            self.quality_func = self.average_precision_score
+            self.quality_metric = 'average_precision'
+        elif self.quality_name != 'auto':
+            self.quality_func = self.top_k_score
+            self.quality_metric = self.quality_name
+        elif self.is_classes_disbalance():
             self.quality_func = self.prc_auc_score
+            self.quality_metric = 'prc_auc'
         else:
             self.quality_func = self.roc_auc_score
+            self.quality_metric = 'roc_auc'
 
     def measure_clf_quality(self, clf_array):
         """Calculate quality for specified classifier."""
         self.set_quality_func()
         if len(clf_array) != len(self.answer_array):
             return None
-        return self.quality_func(clf_array)
+        with self.stage('quality_func'):
+            return self.quality_func(clf_array)
+
+    def measure_clf_scores(self, clf_array):
+        """
+        Calculate all ranking scores for specified classifier.
+
+        With top k quality metric only top k metrics are calculated.
+        """
+        self.set_quality_func()
+        if len(clf_array) != len(self.answer_array):
+            return None
+        with self.stage('quality_func'):
+            if self.quality_metric not in RANKING_METRICS:
+                return {self.quality_metric: self.quality_func(clf_array)}
+            return self.rank_scores(clf_array)
+
+    def top_k_report(self, ks):
+        """
+        Calculate top k metrics for all classifiers.
+
+        Return list with dict of metrics per classifier, None for
+        classifiers with wrong data length, or None for wrong data.
+        """
+        if self.stream:
+            print("Top k metrics aren't supported in stream mode")
+            return None
+        if not self.is_data_ok:
+            return None
+        report = []
+        for f in self.files[:-1]:
+            clf_array = self.load_scores(f)
+            if len(clf_array) == len(self.answer_array):
+                report.append(self.top_k_scores(clf_array, ks))
+            else:
+                report.append(None)
+        return report
+
+    def score_file(self, filename):
+        """Load classifier data file and calculate all ranking scores."""
+        with self.stage('classifier', file=filename):
+            if self.stream:
+                self.set_quality_func()
+                return self.stream_scores(filename)
+            return self.measure_clf_scores(self.load_scores(filename))
+
+    def __getstate__(self):
+        """Return instance state without answers data for pickling."""
+        state = self.__dict__.copy()
+        for key in ('answer_array', 'labels', 'labels_source',
+                    'quality_func'):
+            state[key] = None
+        state['columns'] = {}
+        state['profiler'] = None
+        return state
+
+    def share_labels(self, path):
+        """Save labels index into file for memory mapping by workers."""
+        self.index_answers()
+        np.save(path, self.labels)
+
+    def attach_labels(self, path):
+        """Use labels index saved by 'share_labels' as memory map."""
+        labels = np.load(path, mmap_mode='r')
+        self.answer_array = self.labels = self.labels_source = labels
+        self.quality_func = None
+
+    def score_files_parallel(self, files):
+        """
+        Score classifiers data files in processes pool.
+
+        Labels index is saved once into memory backed file and every
+        worker maps it instead of receiving pickled copy. In stream mode
+        every worker reads answers file by itself.
+        Return scores in the same order as files.
+        """
+        import multiprocessing
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        tmp_dir = tempfile.mkdtemp(prefix='clf_dp_', dir=shm_dir)
+        try:
+            labels_path = None
+            if not self.stream:
+                labels_path = os.path.join(tmp_dir, 'labels.npy')
+                self.share_labels(labels_path)
+            pool = multiprocessing.Pool(min(self.workers, len(files)),
+                                        init_worker, (self, labels_path))
+            try:
+                return pool.map(score_file_worker, files, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def score_files(self, files):
+        """Score classifiers data files, in parallel if it is enabled."""
+        if self.workers > 1 and len(files) > 1:
+            with self.stage('score_files_parallel', files=len(files)):
+                return self.score_files_parallel(files)
+        return [self.score_file(f) for f in files]
+
+    def file_digest(self, filename, stat_index):
+        """
+        Return MD5 digest of file content.
+
+        Digests are kept in 'stat_index' by path, size and modification
+        time, so unchanged files aren't read again.
+        """
+        st = os.stat(filename)
+        entry = stat_index.get(filename)
+        if entry and entry[:2] == [st.st_size, st.st_mtime]:
+            return entry[2]
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(block)
+        stat_index[filename] = [st.st_size, st.st_mtime, md5.hexdigest()]
+        return md5.hexdigest()
+
+    def leaderboard_key(self, name, stat_index):
+        """
+        Return cache key for classifier data file or column.
+
+        Key contains content digests of classifier and answers data and
+        scoring settings.
+        """
+        if self.container is not None:
+            column = name[len(self.container) + 1:]
+            digest = "%s:%s" % (self.file_digest(self.container, stat_index),
+                                column)
+        else:
+            digest = self.file_digest(name, stat_index)
+        answers = self.files[-1]
+        if self.container is not None:
+            answers = self.container
+        settings = [self.quality_metric, self.stream, self.compact]
+        if self.stream:
+            settings += [self.bins, self.decimals, list(self.score_range)]
+        if self.container is not None:
+            settings.append(self.files[-1][len(self.container) + 1:])
+        return "%s|%s|%s" % (digest, self.file_digest(answers, stat_index),
+                             json.dumps(settings))
+
+    def load_leaderboard(self):
+        """Load leaderboard cache, return empty cache for missed file."""
+        try:
+            with open(self.leaderboard) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            cache = {}
+        cache.setdefault('files', {})
+        cache.setdefault('scores', {})
+        return cache
+
+    def save_leaderboard(self, cache):
+        """Save leaderboard cache atomically."""
+        tmp = "%s.%d.tmp" % (self.leaderboard, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, sort_keys=True)
+        os.rename(tmp, self.leaderboard)
+
+    def score_files_cached(self, files):
+        """
+        Score classifiers data files with leaderboard cache.
+
+        Only files which aren't in cache are scored, then cache is saved.
+        """
+        cache = self.load_leaderboard()
+        keys = [self.leaderboard_key(f, cache['files']) for f in files]
+        missed = [(f, k) for f, k in zip(files, keys)
+                  if k not in cache['scores']]
+        self.leaderboard_hits = len(files) - len(missed)
+        missed_scores = self.score_files([f for f, _ in missed])
+        for (_, key), clf_scores in zip(missed, missed_scores):
+            if clf_scores is not None:
+                clf_scores = dict((k, float(v))
+                                  for k, v in clf_scores.items())
+            cache['scores'][key] = clf_scores
+        self.save_leaderboard(cache)
+        scores = []
+        for key in keys:
+            clf_scores = cache['scores'][key]
+            if clf_scores is not None:
+                clf_scores = dict((str(k), np.float64(v))
+                                  for k, v in clf_scores.items())
+            scores.append(clf_scores)
+        return scores
 
     def calculate_quality(self):
         """Calculate quality for all classifiers."""
         if self.is_data_ok:
-            for f in self.files[:-1]:
-                clf_array = np.genfromtxt(f, delimiter=',')
-                clf_quality = self.measure_clf_quality(clf_array)
-                self.quality.append(clf_quality)
+            self.set_quality_func()
+            try:
+                if self.leaderboard:
+                    scores = self.score_files_cached(self.files[:-1])
+                else:
+                    scores = self.score_files(self.files[:-1])
+            except ValueError as e:
+                self.is_data_ok = False
+                print("Can't calculate a quality: %s" % e)
+                return
+            for clf_scores in scores:
+                self.scores.append(clf_scores)
+                if clf_scores is None:
+                    self.quality.append(None)
+                else:
+                    self.quality.append(clf_scores[self.quality_metric])
             if not any(self.quality):
                 self.is_data_ok = False
                 print("Can't calculate a quality for any classifier. \
@@ -117,6 +1410,210 @@ Data lenght in classifiers and answers files don't match")
         else:
             print("Wrong data files, Please see output above.")
 
+    def build_cells(self, clf_arrays):
+        """
+        Group answers rows into cells for weighted scoring.
+
+        Rows in one cell have the same answer and the same score rank in
+        every classifier, so any rows resample is a vector of cells
+        weights. Return cell index of every row, amount of cells and
+        list of (cells order, thresholds starts, cells answers) per
+        classifier, where cells are sorted by descending score.
+        """
+        self.index_answers()
+        ranks = []
+        for clf_array in clf_arrays:
+            order = np.argsort(clf_array, kind='mergesort')[::-1]
+            scores = np.asarray(clf_array)[order]
+            rank = np.empty(len(scores), dtype=np.intp)
+            rank[order] = np.r_[0, np.cumsum(np.diff(scores) != 0)]
+            ranks.append(rank)
+        keys = np.column_stack(ranks + [self.labels.astype(np.intp)])
+        cells, inverse = np.unique(keys, axis=0, return_inverse=True)
+        cells_index = []
+        for c in range(len(clf_arrays)):
+            cells_order = np.argsort(cells[:, c], kind='mergesort')
+            cells_rank = cells[cells_order, c]
+            starts = np.r_[0, np.where(np.diff(cells_rank))[0] + 1]
+            cells_index.append((cells_order, starts, cells[cells_order, -1]))
+        return inverse.reshape(-1), len(cells), cells_index
+
+    def cells_scores(self, weights, cells_order, starts, answers,
+                     metrics=RANKING_METRICS):
+        """
+        Calculate ranking scores for rows of cells weights matrix.
+
+        One sorted pass over cells gives scores for all resamples
+        in 'weights'. ROC AUC is taken as weighted rank sum: every
+        negative row outranks positives of lower thresholds and half
+        of positives with the same threshold. Only scores listed in
+        'metrics' are calculated.
+        """
+        weights = weights[:, cells_order]
+        pos = np.add.reduceat(weights * answers, starts, axis=1,
+                              dtype=np.float64)
+        neg = np.add.reduceat(weights, starts, axis=1, dtype=np.float64) - pos
+        tps = np.cumsum(pos, axis=1)
+        result = {}
+        if 'roc_auc' in metrics:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result['roc_auc'] = (neg * (tps - pos / 2)).sum(axis=1) / (
+                        tps[:, -1] * neg.sum(axis=1))
+        others = [metric for metric in metrics if metric != 'roc_auc']
+        if others:
+            result.update(self.curve_scores(tps, np.cumsum(neg, axis=1),
+                                            others))
+        return result
+
+    def bootstrap_quality(self, resamples=1000, confidence=0.95, seed=None):
+        """
+        Estimate classifiers quality confidence intervals with bootstrap.
+
+        All classifiers are scored on the same resamples of answers rows.
+        Resamples are processed in batches as matrices of cells weights.
+        Return list with dict per classifier with 'quality', 'low',
+        'high' and 'best_probability' keys (None for classifiers
+        which can't be scored) or None for wrong data.
+        """
+        if self.stream:
+            print("Bootstrap isn't supported in stream mode")
+            return None
+        if not self.quality:
+            self.calculate_quality()
+        if not self.is_data_ok:
+            return None
+        self.set_quality_func()
+        if self.quality_metric not in RANKING_METRICS:
+            print("Bootstrap isn't supported for '%s' quality metric" %
+                  self.quality_metric)
+            return None
+        scored = [i for i, q in enumerate(self.quality) if q is not None]
+        clf_arrays = [self.load_scores(self.files[i]) for i in scored]
+        inverse, cells_amount, cells_index = self.build_cells(clf_arrays)
+        rows = len(inverse)
+        # Drawing cells weights directly is faster than drawing rows
+        # when there are much less cells than rows.
+        by_cells = cells_amount * 8 < rows
+        cells_probability = np.bincount(inverse) / float(rows)
+        rnd = np.random.RandomState(seed)
+        batch_width = cells_amount if by_cells else rows
+        batch = max(1, min(resamples, 2 ** 22 // max(batch_width, 1)))
+        quality = np.empty((len(scored), resamples))
+        for start in range(0, resamples, batch):
+            size = min(batch, resamples - start)
+            if by_cells:
+                weights = rnd.multinomial(rows, cells_probability, size)
+            else:
+                sample = inverse[rnd.randint(0, rows, (size, rows))]
+                sample += (np.arange(size) * cells_amount)[:, np.newaxis]
+                weights = np.bincount(sample.ravel(),
+                                      minlength=size * cells_amount)
+                weights = weights.reshape(size, cells_amount)
+            for c, index in enumerate(cells_index):
+                quality[c, start:start + size] = self.cells_scores(
+                        weights, *index, metrics=[self.quality_metric])[
+                                self.quality_metric]
+        alpha = (1.0 - confidence) / 2 * 100
+        low, high = np.nanpercentile(quality, [alpha, 100 - alpha], axis=1)
+        best = np.argmax(np.where(np.isnan(quality), -np.inf, quality),
+                         axis=0)
+        best_probability = np.bincount(best, minlength=len(scored)) / float(
+                resamples)
+        result = [None] * len(self.quality)
+        for c, i in enumerate(scored):
+            result[i] = {'quality': self.quality[i],
+                         'low': low[c],
+                         'high': high[c],
+                         'best_probability': best_probability[c]}
+        return result
+
+    def midranks(self, sorted_scores):
+        """
+        Return midranks for every row of sorted scores 2D array.
+
+        Equal scores get average of their 1-based ranks.
+        """
+        rows, width = sorted_scores.shape
+        is_start = np.ones(sorted_scores.shape, dtype=bool)
+        is_start[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+        is_start = is_start.ravel()
+        starts = np.flatnonzero(is_start)
+        ends = np.r_[starts[1:], rows * width] - 1
+        group_ranks = (starts % width + ends % width) / 2.0 + 1
+        return group_ranks[np.cumsum(is_start) - 1].reshape(rows, width)
+
+    def delong_covariance(self, clf_arrays):
+        """
+        Calculate ROC AUCs and their covariance matrix with fast DeLong.
+
+        Scores of every classifier are sorted once, midranks among all,
+        positive and negative answers are taken from this one sort for
+        all classifiers together, so complexity is O(k * n * log(n)).
+        Return (aucs, covariance).
+        """
+        self.index_answers()
+        is_positive = self.labels.astype(bool)
+        m = self.positive_count
+        n = self.negative_count
+        scores = np.vstack([np.asarray(a) for a in clf_arrays])
+        order = np.argsort(scores, axis=1, kind='mergesort')
+        sorted_scores = np.take_along_axis(scores, order, axis=1)
+        sorted_positive = is_positive[order]
+        all_ranks = self.midranks(sorted_scores)
+        class_ranks = np.empty(scores.shape)
+        class_ranks[sorted_positive] = self.midranks(
+                sorted_scores[sorted_positive].reshape(-1, m)).ravel()
+        class_ranks[~sorted_positive] = self.midranks(
+                sorted_scores[~sorted_positive].reshape(-1, n)).ravel()
+        for ranks in (all_ranks, class_ranks):
+            np.put_along_axis(ranks, order, ranks.copy(), axis=1)
+        positive_ranks = all_ranks[:, is_positive]
+        aucs = (positive_ranks.sum(axis=1) - m * (m + 1) / 2.0) / (m * n)
+        v_positive = (positive_ranks - class_ranks[:, is_positive]) / n
+        v_negative = 1 - (all_ranks[:, ~is_positive] -
+                          class_ranks[:, ~is_positive]) / m
+        covariance = (np.atleast_2d(np.cov(v_positive)) / m +
+                      np.atleast_2d(np.cov(v_negative)) / n)
+        return aucs, covariance
+
+    def delong_test(self):
+        """
+        Compare ROC AUCs of all classifiers pairs with DeLong test.
+
+        Return dict with 'files', 'aucs', 'covariance' and 'p_values'
+        matrix with two-sided p-values of AUCs difference or None for
+        wrong data or answers of one class. Classifiers which can't be
+        scored are skipped.
+        """
+        if self.stream:
+            print("DeLong test isn't supported in stream mode")
+            return None
+        if not self.quality:
+            self.calculate_quality()
+        if not self.is_data_ok:
+            return None
+        self.index_answers()
+        if not self.positive_count or not self.negative_count:
+            print("DeLong test needs answers of both classes")
+            return None
+        files = [f for f, q in zip(self.files, self.quality)
+                 if q is not None]
+        aucs, covariance = self.delong_covariance(
+                [self.load_scores(f) for f in files])
+        p_values = np.ones((len(files), len(files)))
+        for i in range(len(files)):
+            for j in range(i + 1, len(files)):
+                variance = (covariance[i, i] + covariance[j, j] -
+                            2 * covariance[i, j])
+                if variance > 0:
+                    z = abs(aucs[i] - aucs[j]) / math.sqrt(variance)
+                    p_values[i, j] = math.erfc(z / math.sqrt(2))
+                elif aucs[i] != aucs[j]:
+                    p_values[i, j] = 0.0
+                p_values[j, i] = p_values[i, j]
+        return {'files': files, 'aucs': aucs, 'covariance': covariance,
+                'p_values': p_values}
+
     def get_best_quality(self):
         """Return best quality."""
         if self.is_data_ok:
@@ -131,11 +1628,219 @@ Data lenght in classifiers and answers files don't match")
         else:
             return None
 
+
+worker_cdp = None
+
+
+def init_worker(cdp, labels_path):
+    """Prepare classifiers data processor in pool worker."""
+    global worker_cdp
+    worker_cdp = cdp
+    if labels_path is not None:
+        worker_cdp.attach_labels(labels_path)
+
+
+def score_file_worker(filename):
+    """Score classifier data file in pool worker."""
+    return worker_cdp.score_file(filename)
+
+
 if __name__ == '__main__':
-    import sys
-    cdp = ClassifiersDataProcessor(*sys.argv[1:])
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Calculate classifiers quality. Last file must "
+                        "contain right answers.")
+    parser.add_argument('files', nargs='*', metavar='CSV_FILE',
+                        help="classifier results files or directories with "
+                             "them and right answers file or one columnar "
+                             "data file")
+    parser.add_argument('-r', '--report', action='store_true',
+                        help="show ROC AUC, PR AUC and average precision "
+                             "for every classifier")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="amount of processes for classifiers data "
+                             "scoring (default 1)")
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help="read data files by chunks and calculate "
+                             "scores with score histograms")
+    parser.add_argument('--bins', type=int, default=100000,
+                        help="amount of histogram bins in stream mode "
+                             "(default 100000)")
+    parser.add_argument('--decimals', type=int,
+                        help="amount of decimals in classifiers data, "
+                             "gives exact scores in stream mode")
+    parser.add_argument('--score-range', metavar='LOW,HIGH', default='0,1',
+                        help="range of classifiers data values in stream "
+                             "mode (default 0,1)")
+    parser.add_argument('-b', '--bootstrap', type=int, metavar='RESAMPLES',
+                        help="show quality confidence intervals and "
+                             "probability to be the best classifier "
+                             "estimated with RESAMPLES bootstrap resamples")
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help="confidence level for bootstrap intervals "
+                             "(default 0.95)")
+    parser.add_argument('-d', '--delong', action='store_true',
+                        help="show DeLong test p-values for ROC AUC "
+                             "differences of every classifiers pair")
+    parser.add_argument('-c', '--columnar', action='store_true',
+                        help="take answers and all classifiers data from "
+                             "one CSV file with header, '.npy' or '.npz' "
+                             "file")
+    parser.add_argument('--labels-column', metavar='NAME',
+                        help="answers column name in columnar mode "
+                             "(default the last column)")
+    parser.add_argument('-m', '--metrics', metavar='JSON_FILE',
+                        help="save metrics suite report for all "
+                             "classifiers in JSON_FILE ('-' for stdout)")
+    parser.add_argument('--thresholds', default='0.5',
+                        help="comma separated thresholds for precision "
+                             "and recall in metrics suite (default 0.5)")
+    parser.add_argument('--calibration-bins', type=int, default=10,
+                        help="amount of calibration bins in metrics suite "
+                             "(default 10)")
+    parser.add_argument('-g', '--groups', metavar='GROUPS_FILE',
+                        help="calculate scores per segment, GROUPS_FILE "
+                             "contains segment id for every answer")
+    parser.add_argument('--segments-report', metavar='JSON_FILE',
+                        default='-',
+                        help="save segments scores in JSON_FILE "
+                             "(default '-' for stdout)")
+    parser.add_argument('-q', '--quality', default='auto',
+                        help="quality metric for classifiers comparison: "
+                             "roc_auc, prc_auc, average_precision, "
+                             "precision@K, recall@K, lift@K or auto "
+                             "(default auto)")
+    parser.add_argument('-k', '--top-k', metavar='K_LIST',
+                        help="show precision, recall and lift for k "
+                             "highest scores, K_LIST is comma separated "
+                             "k values")
+    parser.add_argument('-l', '--leaderboard', metavar='CACHE_FILE',
+                        help="keep classifiers scores in CACHE_FILE, score "
+                             "only new or changed files and show "
+                             "classifiers ranked by quality")
+    parser.add_argument('--serve', metavar='HOST:PORT',
+                        help="run scoring service on HOST:PORT, CSV_FILE "
+                             "arguments are answers files to preload")
+    parser.add_argument('--compact', action='store_true',
+                        help="keep answers as uint8 and classifiers data "
+                             "as uint16 codes or float32 in memory")
+    parser.add_argument('-p', '--profile', metavar='JSON_FILE',
+                        help="save wall time, CPU time and peak memory of "
+                             "every processing stage in JSON_FILE ('-' "
+                             "for stdout)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("amount of workers must be positive")
+    if args.bins < 1:
+        parser.error("amount of bins must be positive")
+    try:
+        score_range = tuple(float(v) for v in args.score_range.split(','))
+    except ValueError:
+        parser.error("score range bounds must be numbers")
+    if len(score_range) != 2:
+        parser.error("score range must be given as LOW,HIGH")
+    if args.top_k:
+        try:
+            ks = [int(k) for k in args.top_k.split(',')]
+        except ValueError:
+            parser.error("k values must be integers")
+        if min(ks) < 1:
+            parser.error("k values must be positive")
+    if args.serve:
+        from scoring_service import ScoringServer
+        host, _, port = args.serve.rpartition(':')
+        server = ScoringServer((host or '127.0.0.1', int(port)), {
+            'quality': args.quality, 'compact': args.compact})
+        for f in args.files:
+            if server.get_processor(f) is None:
+                parser.error("wrong answers file '%s'" % f)
+        print("Scoring service is listening on %s:%s" % server.server_address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        sys.exit(0)
+    profiler = StageProfiler() if args.profile else None
+    try:
+        cdp = ClassifiersDataProcessor(*args.files, workers=args.workers,
+                                       stream=args.stream, bins=args.bins,
+                                       decimals=args.decimals,
+                                       score_range=score_range,
+                                       columnar=args.columnar,
+                                       labels_column=args.labels_column,
+                                       quality=args.quality,
+                                       leaderboard=args.leaderboard,
+                                       compact=args.compact,
+                                       profiler=profiler)
+    except ValueError as e:
+        parser.error(str(e))
     cdp.calculate_quality()
     if cdp.is_data_ok:
+        if args.report:
+            for f, scores in zip(cdp.files, cdp.scores):
+                if scores is None:
+                    print("'%s': data length doesn't match answers" % f)
+                elif 'roc_auc' not in scores:
+                    print("'%s': %s" % (f, ', '.join(
+                        "%s %s" % item for item in sorted(scores.items()))))
+                else:
+                    print("'%s': ROC AUC %s, PR AUC %s, "
+                          "average precision %s" % (
+                              f, scores['roc_auc'], scores['prc_auc'],
+                              scores['average_precision']))
+                    if 'roc_auc_error' in scores:
+                        print("'%s': ROC AUC error <= %s, PR AUC error <= %s"
+                              % (f, scores['roc_auc_error'],
+                                 scores['prc_auc_error']))
+        if args.bootstrap:
+            bootstrap = cdp.bootstrap_quality(args.bootstrap, args.confidence)
+            for f, interval in zip(cdp.files, bootstrap or []):
+                if interval is not None:
+                    print("'%s': quality %s, %s%% confidence interval "
+                          "[%s, %s], probability to be the best %s" % (
+                              f, interval['quality'], 100 * args.confidence,
+                              interval['low'], interval['high'],
+                              interval['best_probability']))
+        if args.delong:
+            delong = cdp.delong_test()
+            files = delong['files'] if delong else []
+            for i in range(len(files)):
+                for j in range(i + 1, len(files)):
+                    print("'%s' vs '%s': ROC AUC difference %s, "
+                          "p-value %s" % (
+                              files[i], files[j],
+                              delong['aucs'][i] - delong['aucs'][j],
+                              delong['p_values'][i, j]))
+        if args.metrics:
+            report = cdp.metric_report(
+                    [float(t) for t in args.thresholds.split(',')],
+                    args.calibration_bins)
+            if args.metrics == '-':
+                print(json.dumps(report, indent=2, sort_keys=True))
+            else:
+                with open(args.metrics, 'w') as f:
+                    json.dump(report, f, indent=2, sort_keys=True)
+        if args.top_k:
+            for f, scores in zip(cdp.files, cdp.top_k_report(ks) or []):
+                if scores is not None:
+                    print("'%s': %s" % (f, ', '.join(
+                        "%s %s" % item for item in sorted(scores.items()))))
+        if args.groups:
+            report = cdp.segment_report(args.groups)
+            if args.segments_report == '-':
+                print(json.dumps(report, indent=2, sort_keys=True))
+            else:
+                with open(args.segments_report, 'w') as f:
+                    json.dump(report, f, indent=2, sort_keys=True)
+        if args.leaderboard:
+            print("Leaderboard: %d classifiers from cache, %d scored" % (
+                cdp.leaderboard_hits,
+                len(cdp.quality) - cdp.leaderboard_hits))
+            ranked = sorted((q, f) for f, q in zip(cdp.files, cdp.quality)
+                            if q is not None)
+            for place, (q, f) in enumerate(reversed(ranked), 1):
+                print("%d. '%s': %s" % (place, f, q))
         if len(cdp.files) > 2:
             print("Classifier with data in '%s' shows best quality: %s" % (
                 cdp.get_best_classifier(),
@@ -147,3 +1852,9 @@ if __name__ == '__main__':
 
     else:
         print("Can't calculate a quality. Wrong data. See output above")
+    if profiler is not None:
+        if args.profile == '-':
+            print(json.dumps(profiler.report(), indent=2, sort_keys=True))
+        else:
+            with open(args.profile, 'w') as f:
+                json.dump(profiler.report(), f, indent=2, sort_keys=True)
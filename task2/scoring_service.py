@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Module provide scoring service for classifiers data.
+
+Service is imported by 'clf_dp' only for '--serve' option, so HTTP
+modules don't slow down start of other commands.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+from clf_dp import ClassifiersDataProcessor
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle scoring service requests.
+
+    GET /health -- service status and loaded answers files.
+    POST /score?answers=PATH&file=PATH -- score classifier data file.
+    POST /score?answers=PATH[&dtype=<f8] -- score classifier data sent
+        in request body as raw array of 'dtype' numbers.
+    Response is JSON with 'scores', 'quality_metric' and 'quality' keys
+    or with 'error' key.
+    """
+
+    def send_json(self, code, data):
+        """Send JSON response."""
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Return service status."""
+        if urlparse(self.path).path != '/health':
+            self.send_json(404, {'error': "Unknown path"})
+            return
+        self.send_json(200, {'status': 'ok',
+                             'answers': sorted(self.server.processors)})
+
+    def do_POST(self):
+        """Score classifier data."""
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/score':
+            self.send_json(404, {'error': "Unknown path"})
+            return
+        if 'answers' not in params:
+            self.send_json(400, {'error': "'answers' parameter is needed"})
+            return
+        cdp = self.server.get_processor(params['answers'])
+        if cdp is None:
+            self.send_json(400, {'error': "Wrong answers file '%s'" %
+                                          params['answers']})
+            return
+        try:
+            if 'file' in params:
+                f = os.path.abspath(params['file'])
+                if not (os.path.isfile(f) and cdp.is_csv(f)):
+                    raise ValueError("Wrong classifier data file '%s'" %
+                                     params['file'])
+                clf_array = cdp.load_scores(f)
+            else:
+                clf_array = np.frombuffer(body, dtype=np.dtype(
+                        params.get('dtype', '<f8')))
+            clf_scores = cdp.measure_clf_scores(clf_array)
+        except (TypeError, ValueError, IOError, OSError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if clf_scores is None:
+            self.send_json(400, {'error': "Data length doesn't match "
+                                          "answers"})
+            return
+        clf_scores = dict((k, float(v)) for k, v in clf_scores.items())
+        self.send_json(200, {'scores': clf_scores,
+                             'quality_metric': cdp.quality_metric,
+                             'quality': clf_scores[cdp.quality_metric]})
+
+
+class ScoringServer(ThreadingMixIn, HTTPServer):
+    """
+    Scoring service which keeps answers loaded between requests.
+
+    Requests are handled in threads. Answers files are loaded and
+    validated once and loaded again only if they are changed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, options=None):
+        """Initialize server with ClassifiersDataProcessor options."""
+        HTTPServer.__init__(self, address, ScoringRequestHandler)
+        self.options = options or {}
+        self.processors = {}
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def get_processor(self, answers):
+        """
+        Return classifiers data processor for answers file.
+
+        Answers file is loaded without the server lock, so requests for
+        other answers aren't blocked, concurrent requests for the same
+        file wait for one load. Return None for wrong answers file.
+        """
+        path = os.path.abspath(answers)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (st.st_size, st.st_mtime)
+        with self.lock:
+            entry = self.processors.get(path)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+            loading = self.loading.setdefault(path, threading.Lock())
+        with loading:
+            with self.lock:
+                entry = self.processors.get(path)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+            cdp = ClassifiersDataProcessor(answers=path, **self.options)
+            if not cdp.is_data_ok:
+                return None
+            cdp.set_quality_func()
+            with self.lock:
+                self.processors[path] = (key, cdp)
+        return cdp
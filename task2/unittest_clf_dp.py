@@ -3,11 +3,22 @@
 """TODO: add module docs."""
 
 import os
+import json
+import pickle
+import shutil
+import tempfile
+import threading
 import unittest
 import uuid
 import numpy as np
 from sklearn import metrics
-from clf_dp import ClassifiersDataProcessor
+from clf_dp import ClassifiersDataProcessor, QuantizedScores, StageProfiler
+from scoring_service import ScoringServer
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError
 
 
 class ClassifierDataProcessorTestCase(unittest.TestCase):
@@ -17,10 +28,18 @@ class ClassifierDataProcessorTestCase(unittest.TestCase):
         cls.empty_csv = str(uuid.uuid4()) + '.csv'
         with open(cls.empty_csv, 'w'):
             pass
+        cls.tmp_dir = tempfile.mkdtemp()
 
     @classmethod
     def tearDownClass(cls):
         os.remove(cls.empty_csv)
+        shutil.rmtree(cls.tmp_dir)
+
+    def write_csv(self, lines):
+        fname = os.path.join(self.tmp_dir, str(uuid.uuid4()) + '.csv')
+        with open(fname, 'w') as f:
+            f.write(lines)
+        return fname
 
     def testCheckFile_notExists(self):
         clf = ClassifiersDataProcessor()
@@ -64,6 +83,81 @@ class ClassifierDataProcessorTestCase(unittest.TestCase):
                 clf.is_csv(self.empty_csv),
                 True, "%s is a CSV" % self.empty_csv)
 
+    def testParseCsv(self):
+        clf = ClassifiersDataProcessor()
+        fname = self.write_csv("0.1000\n0.9998\n1.0000\n0.0000\n")
+        self.assertListEqual(
+                clf.parse_csv(fname).tolist(),
+                np.genfromtxt(fname, delimiter=',').tolist(),
+                "fast parser result doesn't match np.genfromtxt")
+
+    def testParseCsv_fallback(self):
+        clf = ClassifiersDataProcessor()
+        fname = self.write_csv("0.1\n\n0.5\nabc\n0.7")
+        result = clf.parse_csv(fname)
+        self.assertEqual(len(result), 4, "%s must have 4 values" % result)
+        self.assertTrue(np.isnan(result[2]), "%s must have NaN" % result)
+
+    def testParseWideCsv_emptyField(self):
+        clf = ClassifiersDataProcessor()
+        fname = self.write_csv("a,b\n0.1,0\n,1\n")
+        result = clf.parse_wide_csv(fname)
+        self.assertTupleEqual(result.shape, (2, 2))
+        self.assertTrue(np.isnan(result[1, 0]), "%s must have NaN" % result)
+
+    def testLoadCsv_noCache(self):
+        clf = ClassifiersDataProcessor(use_cache=False)
+        fname = self.write_csv("0\n1\n1\n")
+        self.assertListEqual(clf.load_csv(fname).tolist(), [0, 1, 1])
+        self.assertFalse(os.path.exists(clf.sidecar_path(fname)),
+                         "sidecar mustn't be created without cache")
+
+    def testLoadCsv_sidecar(self):
+        clf = ClassifiersDataProcessor()
+        fname = self.write_csv("0\n1\n1\n")
+        first = clf.load_csv(fname)
+        self.assertTrue(os.path.exists(clf.sidecar_path(fname)),
+                        "sidecar must be created")
+        second = clf.load_csv(fname)
+        self.assertIsInstance(second, np.memmap,
+                              "cached data must be memory-mapped")
+        self.assertListEqual(second.tolist(), first.tolist())
+
+    def testLoadCsv_changedFile(self):
+        clf = ClassifiersDataProcessor()
+        fname = self.write_csv("0\n1\n1\n")
+        old_sidecar = clf.sidecar_path(fname)
+        clf.load_csv(fname)
+        with open(fname, 'w') as f:
+            f.write("1\n0\n")
+        self.assertListEqual(clf.load_csv(fname).tolist(), [1, 0],
+                             "changed file must be parsed again")
+        self.assertFalse(os.path.exists(old_sidecar),
+                         "outdated sidecar must be removed")
+
+    def testLoadCsv_cacheDir(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        clf = ClassifiersDataProcessor(cache_dir=cache_dir)
+        fname = self.write_csv("0\n1\n")
+        clf.load_csv(fname)
+        self.assertEqual(os.path.dirname(clf.sidecar_path(fname)), cache_dir)
+        self.assertTrue(os.path.exists(clf.sidecar_path(fname)))
+
+    def testLoadCsv_sameNames(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        clf = ClassifiersDataProcessor(cache_dir=cache_dir)
+        fnames = []
+        for text in ("0\n1\n", "1\n1\n0\n"):
+            dir_name = tempfile.mkdtemp(dir=self.tmp_dir)
+            fnames.append(os.path.join(dir_name, 'x.csv'))
+            with open(fnames[-1], 'w') as f:
+                f.write(text)
+            clf.load_csv(fnames[-1])
+        for fname in fnames:
+            self.assertTrue(os.path.exists(clf.sidecar_path(fname)),
+                            "sidecars of files with the same name must be kept")
+        self.assertListEqual(clf.load_csv(fnames[0]).tolist(), [0, 1])
+
     def testParseAnswers_positive(self):
         clf = ClassifiersDataProcessor()
         arr = np.array([0, 1])
@@ -79,6 +173,36 @@ class ClassifierDataProcessorTestCase(unittest.TestCase):
                 clf.parse_answers(arr),
                 False, "%s doesn't contain {0, 1} only" % arr)
 
+    def testParseAnswers_nan(self):
+        clf = ClassifiersDataProcessor()
+        arr = np.array([0, 1, np.nan])
+        self.assertEqual(
+                clf.parse_answers(arr),
+                False, "%s doesn't contain {0, 1} only" % arr)
+
+    def testIndexAnswers(self):
+        clf = ClassifiersDataProcessor()
+        clf.answer_array = np.array([1., 0., 1., 1.])
+        clf.index_answers()
+        labels = clf.labels
+        self.assertEqual(labels.dtype, np.uint8)
+        self.assertTupleEqual((clf.positive_count, clf.negative_count), (3, 1))
+        clf.set_quality_func()
+        clf.index_answers()
+        self.assertIs(clf.labels, labels, "index must be shared while answers are the same")
+        self.assertIsNotNone(clf.quality_func, "quality function must be kept while answers are the same")
+
+    def testIndexAnswers_changedAnswers(self):
+        clf = ClassifiersDataProcessor()
+        arr = np.array([1] * 95)
+        clf.answer_array = np.append(arr, [0] * 5)
+        clf.set_quality_func()
+        arr = np.array([1] * 96)
+        clf.answer_array = np.append(arr, [0] * 4)
+        clf.set_quality_func()
+        self.assertEqual(clf.positive_count, 96)
+        self.assertEqual(clf.quality_func.__name__, clf.prc_auc_score.__name__, "quality function must be selected for new answers")
+
     def testIsClassesDisbalance_positive(self):
         clf = ClassifiersDataProcessor()
         arr = np.array([1] * 96)
@@ -126,6 +250,31 @@ class ClassifierDataProcessorTestCase(unittest.TestCase):
         clf_array = np.array([0.1, 0.4, 0.35, 0.8])
         self.assertEqual(metrics.roc_auc_score(clf.answer_array, clf_array), clf.roc_auc_score(clf_array), "scores don't match")
 
+    def testRankScores_ties(self):
+        clf = ClassifiersDataProcessor()
+        rnd = np.random.RandomState(0)
+        clf.answer_array = rnd.randint(0, 2, 1000)
+        clf_array = np.round(rnd.rand(1000) + clf.answer_array * 0.3, 1)
+        scores = clf.rank_scores(clf_array)
+        precision, recall, _ = metrics.precision_recall_curve(clf.answer_array, clf_array)
+        self.assertAlmostEqual(scores['roc_auc'], metrics.roc_auc_score(clf.answer_array, clf_array))
+        self.assertAlmostEqual(scores['prc_auc'], metrics.auc(recall, precision))
+        self.assertAlmostEqual(scores['average_precision'], metrics.average_precision_score(clf.answer_array, clf_array))
+
+    def testRankScores_oneClass(self):
+        clf = ClassifiersDataProcessor()
+        clf.answer_array = np.array([0, 0, 0])
+        scores = clf.rank_scores(np.array([0.1, 0.4, 0.35]))
+        self.assertTrue(all(np.isnan(v) for v in scores.values()), "scores for one class answers must be NaN")
+
+    def testMeasureClfScores(self):
+        clf = ClassifiersDataProcessor()
+        clf.answer_array = np.array([0, 0, 1, 1])
+        clf_array = np.array([0.1, 0.4, 0.35, 0.8])
+        scores = clf.measure_clf_scores(clf_array)
+        self.assertEqual(clf.quality_metric, 'roc_auc')
+        self.assertEqual(scores[clf.quality_metric], clf.measure_clf_quality(clf_array))
+
     def testMeasureClfQuality_diffArrLen(self):
         clf = ClassifiersDataProcessor()
         clf.answer_array = np.array([0, 0, 1])
@@ -138,6 +287,457 @@ class ClassifierDataProcessorTestCase(unittest.TestCase):
         clf_array = np.array([0.1, 0.4, 0.35, 0.8])
         self.assertEqual(clf.measure_clf_quality(clf_array), 0.75, "error in quality measurement")
 
+    def testCalculateQuality_parallel(self):
+        rnd = np.random.RandomState(1)
+        answers = rnd.randint(0, 2, 500)
+        files = []
+        for shift in (0.1, 0.5, 0.3, 0.2):
+            clf_array = rnd.rand(500) + answers * shift
+            files.append(self.write_csv(''.join("%.4f\n" % x for x in clf_array)))
+        files.append(self.write_csv(''.join("%d\n" % x for x in answers)))
+        seq = ClassifiersDataProcessor(*files)
+        seq.calculate_quality()
+        par = ClassifiersDataProcessor(*files, workers=3)
+        par.calculate_quality()
+        self.assertListEqual(par.quality, seq.quality, "parallel and sequential qualities don't match")
+        self.assertEqual(par.get_best_classifier(), files[1])
+
+    def testGetState_noAnswers(self):
+        clf = ClassifiersDataProcessor()
+        clf.answer_array = np.zeros(10000)
+        clf.set_quality_func()
+        state = pickle.loads(pickle.dumps(clf)).__dict__
+        self.assertIsNone(state['answer_array'], "answers mustn't be pickled")
+        self.assertIsNone(state['labels'], "labels mustn't be pickled")
+        self.assertEqual(state['quality_metric'], clf.quality_metric)
+
+    def testInit_badWorkers(self):
+        self.assertRaises(ValueError, ClassifiersDataProcessor, workers=0)
+
+    def writeStreamData(self, size=2000):
+        rnd = np.random.RandomState(2)
+        answers = rnd.randint(0, 2, size)
+        clf_array = np.round(np.clip(rnd.rand(size) * 0.8 + answers * 0.2, 0, 1), 4)
+        clf_file = self.write_csv(''.join("%.4f\n" % x for x in clf_array))
+        answers_file = self.write_csv(''.join("%d\n" % x for x in answers))
+        return clf_file, answers_file, clf_array, answers
+
+    def testStreamScores_exact(self):
+        clf_file, answers_file, clf_array, answers = self.writeStreamData()
+        clf = ClassifiersDataProcessor(clf_file, answers_file, stream=True, decimals=4, chunk_bytes=100)
+        scores = clf.stream_scores(clf_file)
+        clf.answer_array = answers
+        expected = clf.rank_scores(clf_array)
+        for key in expected:
+            self.assertAlmostEqual(scores[key], expected[key], msg="%s doesn't match" % key)
+        self.assertEqual(scores['roc_auc_error'], 0.0)
+
+    def testStreamScores_errorBound(self):
+        clf_file, answers_file, clf_array, answers = self.writeStreamData()
+        clf = ClassifiersDataProcessor(clf_file, answers_file, stream=True, bins=20, chunk_bytes=333)
+        scores = clf.stream_scores(clf_file)
+        clf.answer_array = answers
+        expected = clf.rank_scores(clf_array)
+        self.assertLessEqual(abs(scores['roc_auc'] - expected['roc_auc']), scores['roc_auc_error'])
+        self.assertLessEqual(abs(scores['prc_auc'] - expected['prc_auc']), scores['prc_auc_error'])
+        self.assertLessEqual(abs(scores['average_precision'] - expected['average_precision']), scores['prc_auc_error'])
+
+    def testStreamScores_diffDataLen(self):
+        clf_file, answers_file, _, _ = self.writeStreamData()
+        short_file = self.write_csv("0.1\n0.2\n")
+        clf = ClassifiersDataProcessor(clf_file, answers_file, stream=True)
+        self.assertIsNone(clf.stream_scores(short_file), "data length don't match")
+
+    def testStreamScores_notQuantized(self):
+        clf_file, answers_file, _, _ = self.writeStreamData()
+        clf = ClassifiersDataProcessor(clf_file, answers_file, stream=True, decimals=2)
+        self.assertRaises(ValueError, clf.stream_scores, clf_file)
+
+    def testStream_badAnswers(self):
+        clf_file, _, _, _ = self.writeStreamData()
+        clf = ClassifiersDataProcessor(clf_file, clf_file, stream=True)
+        self.assertFalse(clf.is_data_ok, "answers must contain only 0 and 1")
+
+    def testCalculateQuality_stream(self):
+        clf_file, answers_file, _, _ = self.writeStreamData()
+        clf = ClassifiersDataProcessor(clf_file, answers_file, use_cache=False)
+        clf.calculate_quality()
+        stream_clf = ClassifiersDataProcessor(clf_file, answers_file, stream=True, decimals=4)
+        stream_clf.calculate_quality()
+        self.assertAlmostEqual(stream_clf.get_best_quality(), clf.get_best_quality())
+        self.assertIsNone(stream_clf.answer_array, "answers mustn't be loaded in stream mode")
+
+    def testCellsScores_resample(self):
+        clf = ClassifiersDataProcessor()
+        rnd = np.random.RandomState(3)
+        answers = rnd.randint(0, 2, 300)
+        clf_arrays = [np.round(rnd.rand(300) + answers * shift, 1) for shift in (0.2, 0.6)]
+        clf.answer_array = answers
+        inverse, cells_amount, cells_index = clf.build_cells(clf_arrays)
+        rows = rnd.randint(0, 300, 300)
+        weights = np.bincount(inverse[rows], minlength=cells_amount)[np.newaxis, :]
+        for clf_array, index in zip(clf_arrays, cells_index):
+            scores = clf.cells_scores(weights, *index)
+            resample = ClassifiersDataProcessor()
+            resample.answer_array = answers[rows]
+            expected = resample.rank_scores(clf_array[rows])
+            for key in expected:
+                self.assertAlmostEqual(scores[key][0], expected[key], msg="%s doesn't match" % key)
+                only = clf.cells_scores(weights, *index, metrics=[key])
+                self.assertListEqual(list(only), [key], "only requested score must be calculated")
+                self.assertAlmostEqual(only[key][0], expected[key])
+
+    def testBootstrapQuality(self):
+        rnd = np.random.RandomState(4)
+        answers = rnd.randint(0, 2, 1000)
+        files = []
+        for shift in (0.1, 2.0):
+            clf_array = rnd.rand(1000) + answers * shift
+            files.append(self.write_csv(''.join("%.4f\n" % x for x in clf_array)))
+        files.append(self.write_csv(''.join("%d\n" % x for x in answers)))
+        clf = ClassifiersDataProcessor(*files)
+        intervals = clf.bootstrap_quality(200, 0.9, seed=0)
+        for quality, interval in zip(clf.quality, intervals):
+            self.assertLessEqual(interval['low'], quality)
+            self.assertGreaterEqual(interval['high'], quality)
+        self.assertEqual(intervals[1]['best_probability'], 1.0, "second classifier is always better")
+        self.assertEqual(intervals[0]['best_probability'], 0.0, "first classifier is always worse")
+
+    def testDelongCovariance(self):
+        clf = ClassifiersDataProcessor()
+        rnd = np.random.RandomState(5)
+        answers = rnd.randint(0, 2, 200)
+        clf.answer_array = answers
+        clf_arrays = [np.round(rnd.rand(200) + answers * shift, 1) for shift in (0.2, 0.5, 0.3)]
+        aucs, covariance = clf.delong_covariance(clf_arrays)
+        v_positive = []
+        v_negative = []
+        for clf_array in clf_arrays:
+            x = clf_array[answers == 1][:, np.newaxis]
+            y = clf_array[answers == 0][np.newaxis, :]
+            psi = (x > y) + 0.5 * (x == y)
+            v_positive.append(psi.mean(axis=1))
+            v_negative.append(psi.mean(axis=0))
+            self.assertAlmostEqual(aucs[len(v_positive) - 1], metrics.roc_auc_score(answers, clf_array))
+        expected = np.cov(v_positive) / len(x) + np.cov(v_negative) / y.shape[1]
+        self.assertTrue(np.allclose(covariance, expected), "covariance doesn't match O(n^2) DeLong")
+
+    def testDelongTest(self):
+        rnd = np.random.RandomState(6)
+        answers = rnd.randint(0, 2, 1000)
+        files = []
+        for shift in (0.1, 0.11, 2.0):
+            clf_array = rnd.rand(1000) + answers * shift
+            files.append(self.write_csv(''.join("%.4f\n" % x for x in clf_array)))
+        files.append(self.write_csv(''.join("%d\n" % x for x in answers)))
+        clf = ClassifiersDataProcessor(*files)
+        delong = clf.delong_test()
+        self.assertListEqual(delong['files'], clf.files[:-1])
+        self.assertGreater(delong['p_values'][0, 1], 0.05, "difference isn't significant")
+        self.assertLess(delong['p_values'][0, 2], 0.05, "difference is significant")
+        self.assertEqual(delong['p_values'][2, 0], delong['p_values'][0, 2])
+
+    def testDelongTest_oneClass(self):
+        files = [self.write_csv("0.1\n0.9\n0.4\n"), self.write_csv("0.5\n0.4\n0.3\n"),
+                 self.write_csv("1\n1\n1\n")]
+        clf = ClassifiersDataProcessor(*files)
+        self.assertIsNone(clf.delong_test(), "DeLong test needs answers of both classes")
+
+    def writeColumnarData(self):
+        rnd = np.random.RandomState(7)
+        answers = rnd.randint(0, 2, 500).astype(np.uint8)
+        columns = [('weak', np.round(rnd.rand(500) + answers * 0.2, 4)),
+                   ('strong', np.round(rnd.rand(500) + answers, 4)),
+                   ('label', answers)]
+        expected = []
+        for _, clf_array in columns[:-1]:
+            single = ClassifiersDataProcessor()
+            single.answer_array = answers
+            expected.append(single.rank_scores(clf_array)['roc_auc'])
+        return columns, expected
+
+    def testColumnar_csv(self):
+        columns, expected = self.writeColumnarData()
+        lines = ["label,weak,strong"] + ["%d,%.4f,%.4f" % (y, w, s) for w, s, y in zip(
+                columns[0][1], columns[1][1], columns[2][1])]
+        fname = self.write_csv('\n'.join(lines) + '\n')
+        clf = ClassifiersDataProcessor(fname, columnar=True, labels_column='label')
+        clf.calculate_quality()
+        self.assertListEqual(clf.files, ["%s:%s" % (fname, n) for n in ('weak', 'strong', 'label')])
+        for quality, value in zip(clf.quality, expected):
+            self.assertAlmostEqual(quality, value)
+        self.assertEqual(clf.get_best_classifier(), "%s:strong" % fname)
+
+    def testColumnar_npz(self):
+        columns, expected = self.writeColumnarData()
+        fname = os.path.join(self.tmp_dir, str(uuid.uuid4()) + '.npz')
+        with open(fname, 'wb') as f:
+            np.savez(f, **dict(columns))
+        clf = ClassifiersDataProcessor(fname, columnar=True, labels_column='label')
+        clf.calculate_quality()
+        qualities = dict(zip(clf.files, clf.quality))
+        self.assertAlmostEqual(qualities["%s:weak" % fname], expected[0])
+        self.assertAlmostEqual(qualities["%s:strong" % fname], expected[1])
+        self.assertIsInstance(clf.load_data("%s:strong" % fname), np.memmap, "stored arrays must be memory-mapped")
+
+    def testColumnar_npy(self):
+        columns, expected = self.writeColumnarData()
+        array = np.zeros(500, dtype=[(n, c.dtype) for n, c in columns])
+        for n, c in columns:
+            array[n] = c
+        fname = os.path.join(self.tmp_dir, str(uuid.uuid4()) + '.npy')
+        np.save(fname, array)
+        clf = ClassifiersDataProcessor(fname, columnar=True)
+        clf.calculate_quality()
+        for quality, value in zip(clf.quality, expected):
+            self.assertAlmostEqual(quality, value)
+        self.assertIsInstance(clf.answer_array, np.memmap, "columns must be views of memory map")
+
+    def testColumnar_noLabels(self):
+        fname = self.write_csv("a,b\n0.1,1\n")
+        clf = ClassifiersDataProcessor(fname, columnar=True, labels_column='label')
+        self.assertFalse(clf.is_data_ok, "file doesn't contain answers column")
+
+    def testMetricSuite(self):
+        clf = ClassifiersDataProcessor()
+        rnd = np.random.RandomState(8)
+        answers = rnd.randint(0, 2, 1000)
+        clf_array = np.round(np.clip(rnd.rand(1000) * 0.7 + answers * 0.3, 0, 1), 2)
+        clf.answer_array = answers
+        suite = clf.metric_suite(clf_array, thresholds=(0.4, 2.0), calibration_bins=5)
+        self.assertAlmostEqual(suite['roc_auc'], metrics.roc_auc_score(answers, clf_array))
+        self.assertAlmostEqual(suite['log_loss'], metrics.log_loss(answers, clf_array))
+        self.assertAlmostEqual(suite['brier_score'], metrics.brier_score_loss(answers, clf_array))
+        best = suite['best_f1']
+        self.assertAlmostEqual(best['f1'], metrics.f1_score(answers, clf_array >= best['threshold']))
+        self.assertAlmostEqual(best['f1'], max(metrics.f1_score(answers, clf_array >= t) for t in np.unique(clf_array)))
+        point = suite['thresholds'][0]
+        self.assertAlmostEqual(point['precision'], metrics.precision_score(answers, clf_array >= 0.4))
+        self.assertAlmostEqual(point['recall'], metrics.recall_score(answers, clf_array >= 0.4))
+        self.assertDictEqual(suite['thresholds'][1], {'threshold': 2.0, 'precision': None, 'recall': 0.0})
+        bins = np.minimum((clf_array * 5).astype(int), 4)
+        for i, calibration in enumerate(suite['calibration']):
+            self.assertEqual(calibration['count'], (bins == i).sum())
+            self.assertAlmostEqual(calibration['fraction_positive'], answers[bins == i].mean())
+            self.assertAlmostEqual(calibration['mean_predicted'], clf_array[bins == i].mean())
+
+    def testMetricReport(self):
+        files = [self.write_csv("0.1\n0.9\n0.4\n"), self.write_csv("0.1\n"), self.write_csv("0\n1\n0\n")]
+        clf = ClassifiersDataProcessor(*files)
+        report = clf.metric_report()
+        self.assertEqual(report['answers'], files[-1])
+        self.assertEqual(report['classifiers'][0]['metrics']['roc_auc'], 1.0)
+        self.assertIsNone(report['classifiers'][1]['metrics'], "data length don't match")
+
+    def testSegmentScores(self):
+        clf = ClassifiersDataProcessor()
+        rnd = np.random.RandomState(9)
+        answers = rnd.randint(0, 2, 2000)
+        codes = rnd.randint(0, 6, 2000)
+        answers[codes == 5] = 1
+        clf_array = np.round(rnd.rand(2000) + answers * 0.3, 1)
+        clf.answer_array = answers
+        segments = clf.segment_scores(clf_array, codes, 7)
+        for code in range(5):
+            single = ClassifiersDataProcessor()
+            single.answer_array = answers[codes == code]
+            expected = single.rank_scores(clf_array[codes == code])
+            for key in expected:
+                self.assertAlmostEqual(segments[key][code], expected[key], msg="%s doesn't match" % key)
+            self.assertEqual(segments['positive'][code], single.answer_array.sum())
+        self.assertTrue(np.isnan(segments['roc_auc'][5]), "segment with one class has no ROC AUC")
+        self.assertEqual(segments['prc_auc'][5], 1.0)
+        self.assertTrue(np.isnan(segments['roc_auc'][6]), "empty segment has no ROC AUC")
+
+    def testSegmentReport_stringIds(self):
+        files = [self.write_csv("0.1\n0.9\n0.4\n0.3\n"), self.write_csv("0\n1\n1\n0\n")]
+        groups = self.write_csv("eu\nus\neu\nus\n")
+        clf = ClassifiersDataProcessor(*files)
+        report = clf.segment_report(groups)
+        self.assertListEqual(report['segments'], ['eu', 'us'])
+        self.assertListEqual(report['classifiers'][0]['segments']['roc_auc'], [1.0, 1.0])
+        self.assertFalse(os.path.exists(clf.sidecar_path(groups)), "string ids mustn't be cached")
+
+    def testSegmentReport_missingFile(self):
+        files = [self.write_csv("0.1\n0.9\n"), self.write_csv("0\n1\n")]
+        clf = ClassifiersDataProcessor(*files)
+        self.assertIsNone(clf.segment_report(os.path.join(self.tmp_dir, str(uuid.uuid4()) + '.csv')))
+
+    def testTopKScores(self):
+        clf = ClassifiersDataProcessor()
+        rnd = np.random.RandomState(10)
+        answers = rnd.randint(0, 2, 1000)
+        clf_array = rnd.rand(1000) + answers * 0.3
+        clf.answer_array = answers
+        scores = clf.top_k_scores(clf_array, [10, 100, 5000])
+        top = np.argsort(clf_array)[::-1]
+        for k in (10, 100, 5000):
+            positive = answers[top[:k]].sum()
+            top_k = min(k, 1000)
+            self.assertAlmostEqual(scores['precision@%d' % k], positive / float(top_k))
+            self.assertAlmostEqual(scores['recall@%d' % k], positive / float(answers.sum()))
+            self.assertAlmostEqual(scores['lift@%d' % k], positive / float(top_k) / answers.mean())
+        self.assertRaises(ValueError, clf.top_k_scores, clf_array, [0])
+
+    def testTopKScores_ties(self):
+        clf = ClassifiersDataProcessor()
+        clf.answer_array = np.array([1, 0, 1, 0, 0])
+        scores = clf.top_k_scores(np.array([0.9, 0.5, 0.5, 0.5, 0.1]), [2])
+        self.assertAlmostEqual(scores['precision@2'], (1 + 1 / 3.0) / 2, msg="tied rows must be counted proportionally")
+
+    def testSetQualityFunc_topK(self):
+        clf = ClassifiersDataProcessor(quality='precision@2')
+        clf.answer_array = np.array([0, 0, 1, 1])
+        self.assertEqual(clf.measure_clf_quality(np.array([0.1, 0.4, 0.35, 0.8])), 0.5)
+        self.assertDictEqual(clf.measure_clf_scores(np.array([0.1, 0.4, 0.35, 0.8])), {'precision@2': 0.5})
+
+    def testInit_badScoreRange(self):
+        self.assertRaises(ValueError, ClassifiersDataProcessor, score_range=(1.0, 0.0))
+
+    def testInit_badQuality(self):
+        self.assertRaises(ValueError, ClassifiersDataProcessor, quality='precision@')
+        self.assertRaises(ValueError, ClassifiersDataProcessor, quality='accuracy@10')
+
+    def testExpandDirs(self):
+        clf_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        for name in ('b.csv', 'a.csv', 'notes.txt', '.a.csv.0123456789abcdef.npy'):
+            open(os.path.join(clf_dir, name), 'w').close()
+        answers = os.path.join(clf_dir, 'labels.csv')
+        clf = ClassifiersDataProcessor()
+        self.assertListEqual(
+                clf.expand_dirs([clf_dir, answers]),
+                [os.path.join(clf_dir, 'a.csv'), os.path.join(clf_dir, 'b.csv'), answers])
+
+    def testLeaderboard(self):
+        answers = self.write_csv("0\n1\n1\n0\n")
+        files = [self.write_csv("0.1\n0.9\n0.4\n0.3\n"), self.write_csv("0.5\n0.4\n0.3\n0.2\n")]
+        cache = os.path.join(self.tmp_dir, str(uuid.uuid4()) + '.json')
+        clf = ClassifiersDataProcessor(*(files + [answers]), leaderboard=cache)
+        clf.calculate_quality()
+        self.assertEqual(clf.leaderboard_hits, 0)
+        files.append(self.write_csv("0.5\n0.6\n0.3\n0.2\n"))
+        clf = ClassifiersDataProcessor(*(files + [answers]), leaderboard=cache)
+        clf.calculate_quality()
+        self.assertEqual(clf.leaderboard_hits, 2, "only new file must be scored")
+        self.assertListEqual(clf.quality, [1.0, 0.5, 0.75])
+        self.assertEqual(clf.get_best_classifier(), files[0])
+        with open(files[0], 'w') as f:
+            f.write("0.90\n0.10\n0.40\n0.30\n")
+        clf = ClassifiersDataProcessor(*(files + [answers]), leaderboard=cache)
+        clf.calculate_quality()
+        self.assertEqual(clf.leaderboard_hits, 2, "changed file must be scored")
+        self.assertEqual(clf.get_best_classifier(), files[2])
+        clf = ClassifiersDataProcessor(*(files + [answers]), leaderboard=cache, compact=True)
+        clf.calculate_quality()
+        self.assertEqual(clf.leaderboard_hits, 0, "compact mode scores must be cached separately")
+
+    def testInit_answersOnly(self):
+        answers = self.write_csv("0\n1\n1\n")
+        clf = ClassifiersDataProcessor(answers=answers)
+        self.assertTrue(clf.is_data_ok, "answers file is enough")
+        self.assertListEqual(clf.files, [answers])
+        self.assertEqual(clf.measure_clf_quality(np.array([0.1, 0.5, 0.7])), 1.0)
+
+    def testScoringServer(self):
+        answers = self.write_csv("0\n1\n1\n0\n")
+        clf_file = self.write_csv("0.1\n0.9\n0.4\n0.3\n")
+        server = ScoringServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+
+        def post(query, data=b''):
+            try:
+                response = urlopen(Request(url + query, data=data))
+                return response.getcode(), json.loads(response.read().decode('utf-8'))
+            except HTTPError as e:
+                return e.code, json.loads(e.read().decode('utf-8'))
+        try:
+            code, result = post("/score?answers=%s&file=%s" % (answers, clf_file))
+            self.assertEqual((code, result['quality']), (200, 1.0))
+            code, result = post("/score?answers=%s&dtype=<f4" % answers,
+                                np.array([0.9, 0.1, 0.2, 0.3], dtype='<f4').tobytes())
+            self.assertEqual((code, result['scores']['roc_auc']), (200, 0.0))
+            code, result = post("/score?answers=%s" % answers, np.zeros(3).tobytes())
+            self.assertEqual(code, 400, "data length doesn't match")
+            code, result = post("/score?answers=%s&file=%s" % (clf_file, clf_file))
+            self.assertEqual(code, 400, "wrong answers file")
+            self.assertEqual(len(server.processors), 1, "answers must be loaded once")
+            code, result = post("/score?answers=%s&file=%s" % (answers, clf_file + '.missing'))
+            self.assertEqual(code, 400, "wrong classifier data file")
+            code, result = post("/score?answers=%s&file=%s" % (answers, clf_file))
+            self.assertEqual(code, 200, "wrong file mustn't break shared processor")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def testScoringServer_concurrentLoad(self):
+        answers = [self.write_csv("0\n1\n"), self.write_csv("1\n0\n")]
+        server = ScoringServer(('127.0.0.1', 0))
+        try:
+            loaded = server.get_processor(answers[0])
+            loading = server.loading.setdefault(os.path.abspath(answers[1]), threading.Lock())
+            result = []
+            with loading:
+                thread = threading.Thread(target=lambda: result.append(server.get_processor(answers[1])))
+                thread.start()
+                self.assertIs(server.get_processor(answers[0]), loaded,
+                              "loaded answers mustn't wait for other answers loading")
+                self.assertListEqual(result, [])
+            thread.join()
+            self.assertIs(result[0], server.get_processor(answers[1]), "answers must be loaded once")
+        finally:
+            server.server_close()
+
+    def testCompactScores(self):
+        clf = ClassifiersDataProcessor(compact=True)
+        codes = clf.compact_scores(np.array([0.25, 0.5, 0.0125]))
+        self.assertEqual(codes.dtype, np.uint16)
+        self.assertEqual(codes.scale, 10000)
+        self.assertListEqual(list(codes[:2]), [2500, 5000])
+        self.assertEqual(codes[1:].scale, 10000, "scale must be kept in slices")
+        clf_array = clf.compact_scores(np.array([0.123456, 0.5]))
+        self.assertEqual(clf_array.dtype, np.float32)
+        self.assertEqual(clf.compact_scores(np.array([7.0, -1.0])).dtype, np.float32)
+
+    def testCalculateQuality_compact(self):
+        rnd = np.random.RandomState(3)
+        answers = rnd.randint(0, 2, 500)
+        files = [self.write_csv("\n".join("%.4f" % v for v in rnd.rand(500) + answers * 0.2) + "\n"),
+                 self.write_csv("\n".join("%.7f" % v for v in rnd.rand(500) + answers * 0.4) + "\n"),
+                 self.write_csv("\n".join(str(v) for v in answers) + "\n")]
+        clf = ClassifiersDataProcessor(*files)
+        compact = ClassifiersDataProcessor(*files, compact=True)
+        self.assertEqual(compact.answer_array.dtype, np.uint8)
+        for name in files[:-1]:
+            scores = clf.measure_clf_scores(clf.load_scores(name))
+            compact_scores = compact.measure_clf_scores(compact.load_scores(name))
+            for metric in scores:
+                self.assertAlmostEqual(scores[metric], compact_scores[metric])
+        self.assertIsInstance(compact.load_scores(files[0]), QuantizedScores)
+
+    def testProfiler(self):
+        files = [self.write_csv("0.1\n0.9\n0.4\n0.3\n"), self.write_csv("0\n1\n1\n0\n")]
+        profiler = StageProfiler()
+        clf = ClassifiersDataProcessor(*files, profiler=profiler)
+        clf.calculate_quality()
+        report = profiler.report()
+        for stage in ('check_file', 'load', 'parse_answers', 'set_quality_func', 'quality_func', 'classifier'):
+            self.assertIn(stage, report['totals'])
+        self.assertEqual(report['totals']['check_file']['count'], 2)
+        classifier = [r for r in report['stages'] if r['stage'] == 'classifier']
+        self.assertEqual(classifier[0]['file'], os.path.abspath(files[0]))
+        for key in ('wall', 'cpu', 'peak_rss', 'peak_rss_growth'):
+            self.assertGreaterEqual(classifier[0][key], 0)
+        json.dumps(report)
+
+    def testProfiler_disabled(self):
+        clf = ClassifiersDataProcessor()
+        self.assertIsNone(clf.profiler)
+        with clf.stage('load', file='x') as stage:
+            self.assertEqual(stage.__class__.__name__, 'NullStage')
+
     def testGetBestQuality_badData(self):
         clf = ClassifiersDataProcessor()
         clf.quality = [1, 2, 3]